@@ -4,34 +4,80 @@ import sys
 import os
 import time
 import argparse
+import fcntl
+import gzip
+import hashlib
+import socket
 import subprocess
+import tempfile
+import threading
 import random
 import traceback
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, StringIO
 from datetime import datetime
 
 EXCEPTION = 0
 now = datetime.now()
 
-
-parser = argparse.ArgumentParser(description='Install and start a test VyOS vm.')
-parser.add_argument('iso', help='ISO file to install')
-parser.add_argument('disk', help='name of disk image file', 
-                            nargs='?',
-                            default='testinstall-{}-{}.img'.format(now.strftime('%Y%m%d-%H%M%S'),
-                                                                   "%04x" % random.randint(0,65535)))
-parser.add_argument('--keep', help='Do not remove disk-image after installation', 
+# Resources given to each VM, also used to size the worker pool
+VM_MEMORY_MB = 1024
+VM_CPUS = 2
+# Memory left for QEMU itself per VM
+VM_OVERHEAD_MB = 256
+# First VNC display tried, the single VM runs always used :99
+VNC_BASE = 99
+DISK_SIZE = '2G'
+# Time a powered down VM gets to exit after system_powerdown and quit
+MONITOR_GRACE = 30
+QCOW2_MAGIC = b'QFI\xfb'
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                         'vyos-install-test')
+
+
+parser = argparse.ArgumentParser(description='Install and start test VyOS vms.')
+parser.add_argument('iso', help='ISO files to install, each one is tested in its own VM',
+                           nargs='+')
+parser.add_argument('--disk', help='name of disk image file, only with a single VM')
+parser.add_argument('--runs', help='Number of VMs to run for each ISO',
+                              type=int,
+                              default=1)
+parser.add_argument('--jobs', help='Number of VMs running at the same time, sized to host CPUs and memory by default',
+                              type=int)
+parser.add_argument('--qemu', help='QEMU system emulator to run, a stub can be used for testing',
+                              default=os.environ.get('QEMU', 'qemu-system-x86_64'))
+parser.add_argument('--qemu-img', help='qemu-img binary',
+                                  default=os.environ.get('QEMU_IMG', 'qemu-img'))
+parser.add_argument('--cache-dir', help='Directory keeping one installed golden image per ISO checksum',
+                                   default=CACHE_DIR)
+parser.add_argument('--cache-size', help='Size in GB the golden images may use, least recently used ones are removed',
+                                    type=float,
+                                    default=20)
+parser.add_argument('--no-cache', help='Always install on a fresh disk image',
+                                  action='store_true',
+                                  default=False)
+parser.add_argument('--reinstall', help='Install again and replace the golden image of the ISO',
+                                   action='store_true',
+                                   default=False)
+parser.add_argument('--shutdown-timeout', help='Seconds a VM gets to power off before it is stopped through the QEMU monitor',
+                                         type=float,
+                                         default=300)
+parser.add_argument('--keep', help='Do not remove disk-image after installation',
                               action='store_true',
                               default=False)
-parser.add_argument('--silent', help='Do not show output on stdout unless an error has occured', 
+parser.add_argument('--silent', help='Do not show output on stdout unless an error has occured',
                               action='store_true',
-                              default=False)   
+                              default=False)
 parser.add_argument('--debug', help='Send all debug output to stdout',
-                               action='store_true', 
-                               default=False)                      
-parser.add_argument('--logfile', help='Log to file')  
+                               action='store_true',
+                               default=False)
+parser.add_argument('--logfile', help='Log to file')
+parser.add_argument('--console-log', help='Write the raw console output of each VM to a gzip file',
+                                     action='store_true',
+                                     default=False)
+parser.add_argument('--logdir', help='Directory for one log file per VM, the current directory when running several VMs')
 
 args = parser.parse_args()
 
@@ -39,33 +85,275 @@ class StreamToLogger(object):
     """
     Fake file-like stream object that redirects writes to a logger instance.
     """
-    def __init__(self, logger, log_level=logging.INFO):
+    def __init__(self, logger, log_level=logging.INFO, raw=None):
         self.logger = logger
         self.log_level = log_level
-        self.linebuf = b''
+        # Binary file getting the console output as it is, before splitting
+        self.raw = raw
+        self.linebuf = bytearray()
         self.ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
 
+    def wants_debug(self):
+        """Return True if any handler of the logger would emit a debug line."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        logger = self.logger
+        while logger:
+            for handler in logger.handlers:
+                if handler.level <= logging.DEBUG:
+                    return True
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        return False
+
+    def emit(self, line):
+        text = str(line, 'utf-8', 'replace').rstrip()
+        if '\x1b' in text:
+            text = self.ansi_escape.sub('', text)
+        self.logger.debug(text)
+
     def write(self, buf):
-        self.linebuf += buf
-        #print('.')
-        while b'\n' in self.linebuf:
-            f = self.linebuf.split(b'\n', 1)
-            if len(f) == 2:
-                self.logger.debug(self.ansi_escape.sub('', f[0].decode(errors="replace").rstrip()))
-                self.linebuf = f[1]
-            #print(f)
+        if self.raw:
+            self.raw.write(buf)
+        if not self.wants_debug():
+            # Nobody reads the lines, skip splitting and decoding
+            del self.linebuf[:]
+            return
+
+        # Each chunk is scanned once, only the trailing partial line is kept
+        view = memoryview(buf)
+        end = buf.find(b'\n')
+        if end < 0:
+            self.linebuf += view
+            return
+        self.linebuf += view[:end]
+        self.emit(self.linebuf)
+        del self.linebuf[:]
+        start = end + 1
+        while True:
+            end = buf.find(b'\n', start)
+            if end < 0:
+                break
+            self.emit(view[start:end])
+            start = end + 1
+        self.linebuf += view[start:]
 
 
     def flush(self):
         pass
 
+    def close(self):
+        """Log the last line if it did not end with a newline and close the raw file."""
+        if self.linebuf and self.wants_debug():
+            self.emit(self.linebuf)
+        del self.linebuf[:]
+        if self.raw:
+            self.raw.close()
+            self.raw = None
+
+
+class VM(object):
+    """
+    Resources of one test VM, allocated so concurrent VMs on a host do not collide.
+    """
+    def __init__(self, index, iso, disk, ssh_port, vnc_display, mac, reservations=()):
+        self.index = index
+        self.name = 'TESTVM{}'.format(index)
+        self.iso = iso
+        self.disk = disk
+        self.ssh_port = ssh_port
+        self.vnc_display = vnc_display
+        self.mac = mac
+        # Lock files reserving the SSH port and VNC display until QEMU is gone
+        self.reservations = list(reservations)
+        self.disk_format = 'qcow2'
+        # Installed image shared by all runs of the same ISO
+        self.golden = None
+        self.monitor = os.path.join(tempfile.gettempdir(),
+                                    'vyos-install-test-{}-{}.monitor'.format(os.getpid(), index))
+        self.logfile = None
+        self.log = logging.getLogger(self.name)
+
+    def command(self, cdrom=False):
+        """Return the QEMU command line, booting the ISO when cdrom is set."""
+        cmd = [args.qemu,
+               '-name', self.name,
+               '-m', '{}M'.format(VM_MEMORY_MB),
+               '-nic', 'user,model=virtio,mac={},hostfwd=tcp::{}-:22'.format(self.mac, self.ssh_port),
+               '-machine', 'accel=kvm',
+               '-cpu', 'host', '-smp', str(VM_CPUS),
+               '-vnc', '0.0.0.0:{}'.format(self.vnc_display),
+               '-monitor', 'unix:{},server,nowait'.format(self.monitor),
+               '-nographic']
+        if cdrom:
+            cmd += ['-boot', 'd', '-cdrom', self.iso]
+        cmd += ['-drive', 'format={},file={}'.format(self.disk_format, self.disk)]
+        return cmd
+
+
+def reserve(kind, number):
+    """Take the host wide reservation of a port or display, return its lock file or None."""
+    # A port is free from the time it is probed until QEMU binds it, other
+    # test runs on the host skip ports and displays reserved here. flock
+    # also conflicts within this process, so VMs of one run skip them too
+    lock = open(os.path.join(tempfile.gettempdir(),
+                             'vyos-install-test-{}-{}.lock'.format(kind, number)), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def free_port(reservations):
+    """Return a TCP port that is free right now, its reservation is added to reservations."""
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+        lock = reserve('port', port)
+        if lock:
+            reservations.append(lock)
+            return port
+
+
+def free_vnc_display(reservations):
+    """Return the first VNC display from VNC_BASE that is free, its reservation is added to reservations."""
+    display = VNC_BASE
+    while True:
+        lock = reserve('vnc', display)
+        if lock:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.bind(('', 5900 + display))
+                    reservations.append(lock)
+                    return display
+                except OSError:
+                    # Used by something else than a test VM
+                    lock.close()
+        display += 1
+
+
+def random_mac(taken):
+    """Return a MAC in the 52:54:99 range used for test VMs that is not taken."""
+    while True:
+        bits = random.getrandbits(24)
+        mac = '52:54:99:{:02x}:{:02x}:{:02x}'.format(bits >> 16, bits >> 8 & 0xFF, bits & 0xFF)
+        if mac not in taken:
+            return mac
+
+
+def host_jobs():
+    """Return how many VMs this host can run at once."""
+    jobs = max(1, (os.cpu_count() or 1) // VM_CPUS)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available_mb = int(line.split()[1]) // 1024
+                    jobs = min(jobs, max(1, available_mb // (VM_MEMORY_MB + VM_OVERHEAD_MB)))
+                    break
+    except OSError:
+        pass
+    return jobs
+
+
+def iso_checksum(iso):
+    """Return the sha256 of an ISO file."""
+    h = hashlib.sha256()
+    with open(iso, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def disk_format(disk):
+    """Return the format of an existing disk image, qcow2 or raw."""
+    with open(disk, 'rb') as f:
+        return 'qcow2' if f.read(4) == QCOW2_MAGIC else 'raw'
+
+
+def evict_cache(keep):
+    """Remove the least recently used golden images until the cache fits in --cache-size."""
+    images = []
+    for name in os.listdir(args.cache_dir):
+        if name.endswith('.qcow2'):
+            image = os.path.join(args.cache_dir, name)
+            st = os.stat(image)
+            images.append((st.st_mtime, st.st_size, image))
+    images.sort()
+    total = sum(size for _, size, _ in images)
+    for _, size, image in images:
+        if total <= args.cache_size * (1 << 30):
+            break
+        if image == keep:
+            continue
+        with open(image + '.lock', 'a') as lock:
+            try:
+                # Images booted by running VMs are kept
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            log.info("Removing cached installation {}".format(image))
+            os.remove(image)
+            # Nobody installs without the shared lock, so the install lock
+            # is unused
+            try:
+                os.remove(image + '.install')
+            except FileNotFoundError:
+                pass
+            # Waiters on this lock file notice it is gone and open a new one
+            os.remove(image + '.lock')
+            total -= size
+
+
+def lock_image(golden):
+    """Open the lock file of a golden image and take a shared lock on it."""
+    while True:
+        lock = open(golden + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(lock.name).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        # Removed by evict_cache() while waiting
+        lock.close()
+
+
+def allocate_vms():
+    """Return one VM per ISO and run with its own ports, display, MAC and disk."""
+    stamp = '{}-{}'.format(now.strftime('%Y%m%d-%H%M%S'), "%04x" % random.randint(0,65535))
+    runs = [iso for iso in args.iso for _ in range(args.runs)]
+    vms = []
+    macs = set()
+    checksums = {}
+    for index, iso in enumerate(runs, 1):
+        if args.disk:
+            disk = args.disk
+        elif len(runs) == 1:
+            disk = 'testinstall-{}.img'.format(stamp)
+        else:
+            disk = 'testinstall-{}-{}.img'.format(stamp, index)
+        reservations = []
+        vm = VM(index, iso, disk, free_port(reservations), free_vnc_display(reservations),
+                random_mac(macs), reservations)
+        if not args.no_cache and not os.path.isfile(disk):
+            if iso not in checksums:
+                checksums[iso] = iso_checksum(iso)
+            vm.golden = os.path.join(args.cache_dir, '{}.qcow2'.format(checksums[iso]))
+        macs.add(vm.mac)
+        vms.append(vm)
+    return vms
+
 
 # Setting up logger
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
-stl = StreamToLogger(log)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 handler = logging.StreamHandler(sys.stdout)
 if args.silent:
@@ -92,41 +380,35 @@ if args.silent:
 else:
     output = sys.stdout.buffer
 
-if not os.path.isfile(args.iso):
-    log.error("Unable to find iso image to install")
-    sys.exit(1)
-
+# The disk used to be the second positional argument, ISO names did not need
+# to end in .iso then, so only a second argument that does not is taken
+if args.disk is None and len(args.iso) == 2 and not args.iso[1].endswith('.iso'):
+    log.warning("Giving the disk image as second argument is deprecated, "
+                "use --disk {}".format(args.iso[1]))
+    args.disk = args.iso.pop()
 
-# Creating diskimage!!
+for iso in args.iso:
+    if not os.path.isfile(iso):
+        log.error("Unable to find iso image to install: {}".format(iso))
+        sys.exit(1)
 
-if not os.path.isfile(args.disk):
-    log.info("Creating Disk image {}".format(args.disk))
-    c = subprocess.check_output(["qemu-img", "create", args.disk, "2G"])
-    log.debug(c.decode())
-else:
-    log.info("Diskimage already exists, using the existing one")
+if args.disk and len(args.iso) * args.runs > 1:
+    log.error("A disk image name can only be given for a single VM")
+    sys.exit(1)
 
 
+def install(vm, stl):
+    """Install the ISO of vm on its disk and power the installer off."""
+    log = vm.log
 
-try:
     #################################################
     # Installing image to disk
     #################################################
-    log.info("Installing system")
-
-    cmd = """qemu-system-x86_64 \
-    -name "TESTVM" \
-    -m 1G \
-    -nic user,model=virtio,mac=52:54:99:12:34:56,hostfwd=tcp::2299-:22 \
-    -machine accel=kvm \
-    -cpu host -smp 2 \
-    -vnc 0.0.0.0:99 \
-    -nographic \
-    -boot d -cdrom {CD} \
-    -drive format=raw,file={DISK}
-    """.format(CD=args.iso, DISK=args.disk)
-    log.debug("Executing command: {}".format(cmd))
-    c = pexpect.spawn(cmd, logfile=stl)
+    log.info("Installing system from {}".format(vm.iso))
+
+    cmd = vm.command(cdrom=True)
+    log.debug("Executing command: {}".format(' '.join(cmd)))
+    c = pexpect.spawn(cmd[0], cmd[1:], logfile=stl)
 
     #################################################
     # Logging into VyOS system
@@ -185,131 +467,312 @@ try:
     c.sendline('poweroff')
     c.expect(r'\nAre you sure you want to poweroff this system.*\]')
     c.sendline('Y')
-    for i in range(30):
-        log.info("Waiting for shutdown...")
-        if not c.isalive():
-            log.info("VM is shut down!")
-            break
-        time.sleep(10) 
-    else:
-        log.error("VM Did not shut down after 300sec, killing")
-    c.close()
+    if not wait_for_shutdown(vm, c):
+        log.error("VM Did not shut down after {:.0f}sec, killed".format(args.shutdown_timeout))
 
 
-    #################################################
-    # Booting installed system
-    #################################################
-    log.info("Booting installed system")
-
-    cmd = """qemu-system-x86_64 \
-    -name "TESTVM" \
-    -m 1G \
-    -nic user,model=virtio,mac=52:54:99:12:34:56,hostfwd=tcp::2299-:22
-    -machine accel=kvm \
-    -cpu host -smp 2 \
-    -vnc 0.0.0.0:99 \
-    -nographic \
-    -drive format=raw,file={DISK}
-    """.format(DISK=args.disk)
-
-    log.debug('Executing command: {}'.format(cmd))
-    c = pexpect.spawn(cmd, logfile=stl)
-
-    #################################################
-    # Logging into VyOS system
-    #################################################
+def monitor_command(vm, command):
+    """Send a command to the QEMU monitor of vm, return False if it could not be sent."""
     try:
-        c.expect('The highlighted entry will be executed automatically in', timeout=10)
-        c.sendline('')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(5)
+            s.connect(vm.monitor)
+            # Wait for the prompt, then for the reply so the command is read
+            s.recv(4096)
+            s.sendall(command.encode() + b'\n')
+            s.recv(4096)
+        return True
+    except OSError:
+        return False
+
+
+def wait_for_shutdown(vm, c):
+    """Wait for QEMU to exit after poweroff, return False if it had to be stopped."""
+    log = vm.log
+    log.info("Waiting for shutdown...")
+    try:
+        # Reading until EOF keeps draining the console while waiting
+        c.expect(pexpect.EOF, timeout=args.shutdown_timeout)
+        log.info("VM is shut down!")
+        c.close()
+        return True
     except pexpect.TIMEOUT:
-        log.warning("Did not find grub countdown window, ignoring")
+        pass
 
-    log.info('Waiting for login prompt')
-    c.expect('[Ll]ogin:', timeout=120)
-    c.sendline('vyos')
-    c.expect('[Pp]assword:', timeout=10)
-    c.sendline('vyos')
-    c.expect(r'vyos@vyos:~\$')
-    log.info('Logged in!')
+    for command in ('system_powerdown', 'quit'):
+        log.warning("VM did not shut down, sending {} to the monitor".format(command))
+        if monitor_command(vm, command):
+            try:
+                c.expect(pexpect.EOF, timeout=MONITOR_GRACE)
+                break
+            except pexpect.TIMEOUT:
+                pass
+    c.close(force=True)
+    return False
+
+
+def create_disk(vm):
+    """Create an empty disk image for vm."""
+    log = vm.log
+    log.info("Creating Disk image {}".format(vm.disk))
+    c = subprocess.check_output([args.qemu_img, "create", "-f", "qcow2", vm.disk, DISK_SIZE])
+    log.debug(c.decode())
 
 
+def prepare_disk(vm, stl):
+    """Give vm an installed disk, return the golden image lock held while it runs."""
+    log = vm.log
+
+    if os.path.isfile(vm.disk):
+        log.info("Diskimage already exists, using the existing one")
+        vm.disk_format = disk_format(vm.disk)
+        install(vm, stl)
+        return None
+
+    if vm.golden is None:
+        create_disk(vm)
+        install(vm, stl)
+        return None
+
+    def cached():
+        with reinstalled_lock:
+            replace = args.reinstall and vm.golden not in reinstalled
+        return os.path.isfile(vm.golden) and not replace
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    # Shared while the VM runs so the image is not evicted under it, any
+    # number of VMs can boot overlays of the same image at once
+    lock = lock_image(vm.golden)
+    install_lock = None
+    try:
+        if not cached():
+            # One VM installs an ISO, the others wait for its golden image.
+            # The install lock is held only while installing, a VM that
+            # waited for it does not wait for the installing VM to finish
+            install_lock = open(vm.golden + '.install', 'a')
+            fcntl.flock(install_lock, fcntl.LOCK_EX)
+        if cached():
+            log.info("Using cached installation {}".format(vm.golden))
+            c = subprocess.check_output([args.qemu_img, "create", "-f", "qcow2",
+                                         "-b", os.path.abspath(vm.golden), "-F", "qcow2", vm.disk])
+            log.debug(c.decode())
+            # The modification time orders the cache for eviction
+            os.utime(vm.golden)
+        else:
+            create_disk(vm)
+            install(vm, stl)
+            log.info("Saving installation as {}".format(vm.golden))
+            # A unique name, the file of an interrupted run is not reused
+            fd, tmp = tempfile.mkstemp(dir=args.cache_dir,
+                                       prefix=os.path.basename(vm.golden) + '.', suffix='.tmp')
+            os.close(fd)
+            try:
+                c = subprocess.check_output([args.qemu_img, "convert", "-O", "qcow2", vm.disk, tmp])
+                log.debug(c.decode())
+                # Replacing under the shared lock is safe, VMs that booted
+                # keep the old image open and overlays not booted yet are
+                # still empty
+                os.replace(tmp, vm.golden)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            with reinstalled_lock:
+                reinstalled.add(vm.golden)
+            evict_cache(vm.golden)
+    except BaseException:
+        lock.close()
+        raise
+    finally:
+        if install_lock:
+            install_lock.close()
+    return lock
+
+
+def run_vm(vm):
+    """Install the ISO of vm, boot it and run the smoketest, return True on success."""
+    log = vm.log
+    raw = None
+    if args.console_log:
+        # Fast compression, console output compresses well anyway
+        raw = gzip.open('{}.console.gz'.format(os.path.splitext(vm.logfile or vm.disk)[0]), 'wb',
+                        compresslevel=1)
+    stl = StreamToLogger(log, raw=raw)
+    EXCEPTION = 0
+    lock = None
+
+    try:
+        #################################################
+        # Preparing disk, installing when not cached
+        #################################################
+        lock = prepare_disk(vm, stl)
+
+
+        #################################################
+        # Booting installed system
+        #################################################
+        log.info("Booting installed system")
+
+        cmd = vm.command()
+        log.debug('Executing command: {}'.format(' '.join(cmd)))
+        c = pexpect.spawn(cmd[0], cmd[1:], logfile=stl)
+
+        #################################################
+        # Logging into VyOS system
+        #################################################
+        try:
+            c.expect('The highlighted entry will be executed automatically in', timeout=10)
+            c.sendline('')
+        except pexpect.TIMEOUT:
+            log.warning("Did not find grub countdown window, ignoring")
+
+        log.info('Waiting for login prompt')
+        c.expect('[Ll]ogin:', timeout=120)
+        c.sendline('vyos')
+        c.expect('[Pp]assword:', timeout=10)
+        c.sendline('vyos')
+        c.expect(r'vyos@vyos:~\$')
+        log.info('Logged in!')
+
+
+
+        #################################################
+        # Executing test-suite
+        #################################################
+        log.info("Executing test-suite ")
+
+        def cr(child, command):
+            child.sendline(command)
+            i = child.expect(['\n +Invalid command:',
+                            '\n +Set failed',
+                            'No such file or directory',
+                            r'\n\S+@\S+[$#]'])
+
+            if i==0:
+                raise Exception('Invalid command detected')
+            elif i==1:
+                raise Exception('Set syntax failed :/')
+            elif i==2:
+                log.error("Did not find VyOS-smoketest, this should be an exception")
+                #raise Exception("WTF? did not find VyOS-smoketest, this should be an exception")
+        cr(c, '/usr/bin/vyos-smoketest')
+
+        log.info("Smoke test status")
+        #data = c.before.decode()
+
+        #################################################
+        # Powering off system
+        #################################################
+        log.info("Powering off system ")
+        c.sendline('poweroff')
+        c.expect(r'\nAre you sure you want to poweroff this system.*\]')
+        c.sendline('Y')
+        log.info("Shutting down virtual machine")
+        if not wait_for_shutdown(vm, c):
+            log.error("VM Did not shut down after {:.0f}sec".format(args.shutdown_timeout))
+            raise Exception("VM Did not shut down after {:.0f}sec".format(args.shutdown_timeout))
+
+    except pexpect.exceptions.TIMEOUT:
+        log.error("Timeout waiting for VyOS system")
+        log.error(traceback.format_exc())
+        EXCEPTION = 1
+
+    except pexpect.exceptions.ExceptionPexpect:
+        log.error("Exeption while executing QEMU")
+        log.error("Is qemu working on this system?")
+        log.error(traceback.format_exc())
+        EXCEPTION = 1
+
+    except Exception:
+        log.error("An unknown error occured when installing the VyOS system")
+        log.error(traceback.format_exc())
+        EXCEPTION = 1
+
 
-    #################################################
-    # Executing test-suite
-    #################################################
-    log.info("Executing test-suite ")
-
-    def cr(child, command):
-        child.sendline(command)
-        i = child.expect(['\n +Invalid command:', 
-                        '\n +Set failed', 
-                        'No such file or directory', 
-                        r'\n\S+@\S+[$#]'])
-
-        if i==0:
-            raise Exception('Invalid command detected')
-        elif i==1:
-            raise Exception('Set syntax failed :/')
-        elif i==2:
-            log.error("Did not find VyOS-smoketest, this should be an exception")
-            #raise Exception("WTF? did not find VyOS-smoketest, this should be an exception")
-    cr(c, '/usr/bin/vyos-smoketest')
-
-    log.info("Smoke test status")
-    #data = c.before.decode()
 
     #################################################
-    # Powering off system
+    # Cleaning up
     #################################################
-    log.info("Powering off system ")
-    c.sendline('poweroff')
-    c.expect(r'\nAre you sure you want to poweroff this system.*\]')
-    c.sendline('Y')
-    log.info("Shutting down virtual machine")
-    for i in range(30):
-        log.info("Waiting for shutdown...")
-        if not c.isalive():
-            log.info("VM is shut down!")
-            break
-        time.sleep(10) 
-    else:
-        log.error("VM Did not shut down after 300sec")
-        raise Exception("VM Did not shut down after 300sec")
-    c.close()
+    log.info("Cleaning up")
 
-except pexpect.exceptions.TIMEOUT:
-    log.error("Timeout waiting for VyOS system")
-    log.error(traceback.format_exc())
-    EXCEPTION = 1
+    stl.close()
 
-except pexpect.exceptions.ExceptionPexpect:
-    log.error("Exeption while executing QEMU")
-    log.error("Is qemu working on this system?")
-    log.error(traceback.format_exc())
-    EXCEPTION = 1
+    if lock:
+        lock.close()
 
-except Exception:
-    log.error("An unknown error occured when installing the VyOS system")
-    traceback.print_exc()
-    EXCEPTION = 1
+    # QEMU is gone, the port and display can be handed out again
+    for reservation in vm.reservations:
+        reservation.close()
 
+    try:
+        os.remove(vm.monitor)
+    except FileNotFoundError:
+        pass
+
+    if not args.keep:
+        log.info("Removing disk file: {}".format(vm.disk))
+        try:
+            os.remove(vm.disk)
+        except Exception:
+            log.error("Exception while removing diskimage")
+            log.error(traceback.format_exc())
+            EXCEPTION = 1
+
+    return not EXCEPTION
+
+
+def run_logged(vm):
+    """Run vm with its own log file when running several VMs, return (passed, seconds)."""
+    filehandler = None
+    if vm.logfile:
+        filehandler = logging.FileHandler(vm.logfile)
+        filehandler.setLevel(logging.DEBUG)
+        filehandler.setFormatter(formatter)
+        vm.log.addHandler(filehandler)
+    start = time.monotonic()
+    try:
+        passed = run_vm(vm)
+    except Exception:
+        # Failing to create the disk ends up here
+        vm.log.error(traceback.format_exc())
+        passed = False
+    finally:
+        if filehandler:
+            vm.log.removeHandler(filehandler)
+            filehandler.close()
+    return passed, time.monotonic() - start
+
+
+# Golden images written by this run, --reinstall replaces each one once.
+# VMs run in threads of the pool, so it is only used with reinstalled_lock
+reinstalled = set()
+reinstalled_lock = threading.Lock()
+
+vms = allocate_vms()
+logdir = args.logdir or ('.' if len(vms) > 1 else None)
+for vm in vms:
+    if logdir:
+        vm.logfile = os.path.join(logdir, '{}.log'.format(os.path.splitext(os.path.basename(vm.disk))[0]))
+    log.debug("{}: iso {} disk {} ssh port {} vnc :{} mac {}".format(
+        vm.name, vm.iso, vm.disk, vm.ssh_port, vm.vnc_display, vm.mac))
+
+jobs = args.jobs or host_jobs()
+log.info("Running {} VMs, {} at a time".format(len(vms), min(jobs, len(vms))))
+with ThreadPoolExecutor(max_workers=jobs) as pool:
+    results = list(pool.map(run_logged, vms))
 
 
 #################################################
-# Cleaning up
+# Summary
 #################################################
-log.info("Cleaning up")
-
-if not args.keep:
-    log.info("Removing disk file: {}".format(args.disk))
-    try:
-        os.remove(args.disk)
-    except Exception:
-        log.error("Exception while removing diskimage")
-        log.error(traceback.format_exc())
+for vm, (passed, seconds) in zip(vms, results):
+    if not passed:
         EXCEPTION = 1
+    if len(vms) > 1:
+        (log.info if passed else log.error)("{} {} {} in {:.0f}s{}".format(
+            vm.name, 'PASS' if passed else 'FAIL', vm.iso, seconds,
+            ', log in {}'.format(vm.logfile) if vm.logfile else ''))
 
 if EXCEPTION:
     log.error("Hmm... System got an exception while processing")
     log.error("The ISO is not considered usable")
-    sys.exit(1)
\ No newline at end of file
+    sys.exit(1)
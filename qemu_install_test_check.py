@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Run qemu_install_test.py against stub QEMU and qemu-img binaries."""
+
+import argparse
+import ast
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+HERE = path.dirname(path.abspath(__file__))
+
+# Plays the VyOS installer and installed system on the console, binds the
+# forwarded SSH port and the VNC port like QEMU and answers the monitor
+QEMU_STUB = r'''#!/usr/bin/env python3
+import os, re, socket, sys, threading, time
+
+def monitor(filename):
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(filename)
+    server.listen(1)
+    while True:
+        conn, _ = server.accept()
+        conn.sendall(b"QEMU monitor\n(qemu) ")
+        command = conn.recv(100).strip()
+        conn.sendall(command + b"\r\n(qemu) ")
+        if command in (b"quit", b"system_powerdown"):
+            os.unlink(filename)
+            os._exit(0)
+
+def out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def ask(prompt):
+    out(prompt)
+    return sys.stdin.readline()
+
+args = sys.argv[1:]
+listening = []
+for value in args:
+    port = re.search(r"hostfwd=tcp::(\d+)-", value)
+    vnc = re.match(r"0\.0\.0\.0:(\d+)$", value)
+    if port or vnc:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("", int(port.group(1)) if port else 5900 + int(vnc.group(1))))
+        except OSError as e:
+            sys.exit("qemu: {}: {}".format(value, e.strerror))
+        listening.append(s)
+    if value.startswith("unix:"):
+        threading.Thread(target=monitor, args=(value[5:].split(",")[0],), daemon=True).start()
+
+out("booting {}\n".format(" ".join(args)))
+if "-cdrom" in args:
+    ask("Automatic boot in 5\n")
+else:
+    ask("The highlighted entry will be executed automatically in 5s.\n")
+out("\x1b[0mWelcome\n" * 50)
+ask("vyos login: ")
+ask("Password: ")
+out("\nvyos@vyos:~$ ")
+if sys.stdin.readline().startswith("install"):
+    for prompt in ("Would you like to continue? (Yes/No) [Yes]:",
+                   "Partition (Auto/Parted/Skip) [Auto]:",
+                   "Install the image on? [sda]:",
+                   "Continue? (Yes/No) [No]:",
+                   "How big of a root partition should I create? (2000MB - 2147MB) [2147]MB:",
+                   "What would you like to name this image? [1.3]:",
+                   "Which one should I copy to sda? [/config/config.boot]:",
+                   "Enter password for user 'vyos':",
+                   "Retype password for user 'vyos':",
+                   "Which drive should GRUB modify the boot partition on? [sda]:"):
+        ask("\n" + prompt)
+    out("\nvyos@vyos:~$ ")
+else:
+    out("running smoketest\n" * 10 + "\nvyos@vyos:~$ ")
+ask("")
+ask("\nAre you sure you want to poweroff this system? [y/N]")
+out("powering off\n")
+time.sleep(float(os.environ.get("STUB_SHUTDOWN", "0.2")))
+'''
+
+# Creates qcow2 files with just the magic and copies on convert
+QEMU_IMG_STUB = r'''#!/bin/sh
+case "$1" in
+create) for a; do last2=$last; last=$a; done
+        case "$*" in *" -b "*) f=$last;; *) f=$last2;; esac
+        printf 'QFI\373' > "$f"
+        echo "Formatting '$f'";;
+convert) for a; do last2=$last; last=$a; done
+         cp "$last2" "$last";;
+esac
+'''
+
+"""Check workflow
+1: write the stubs and two ISOs to a temp directory
+
+2: run two ISOs twice each, four VMs at a time, with an empty cache, every
+   VM passes and each ISO is installed once
+
+3: run the same again and every VM boots the cached installation
+
+4: while a run with a slow shutdown boots the cached installation, run
+   --reinstall of the same ISO, it replaces the image without waiting for
+   the other run to finish
+
+5: start two runs at the same time, the SSH ports and VNC displays of all
+   their VMs differ and every VM passes, the stub fails to start like QEMU
+   when a port is in use
+
+6: give the disk image as second positional argument, it is used with a
+   deprecation warning
+
+With --console StreamToLogger of qemu_install_test.py is timed splitting a
+synthetic console dump written in one chunk and in 4k chunks, next to the
+StreamToLogger it replaced.
+"""
+
+
+def write(filename, content, mode=0o644):
+    """Write a file with the given mode."""
+    with open(filename, "w") as f:
+        f.write(content)
+    os.chmod(filename, mode)
+
+
+def start_test(tmp, *arguments, shutdown=0.2):
+    """Start qemu_install_test.py with the stubs, the stub VMs power off in shutdown seconds."""
+    command = [sys.executable, path.join(HERE, "qemu_install_test.py"), "--debug",
+               "--qemu", path.join(tmp, "qemu"), "--qemu-img", path.join(tmp, "qemu-img"),
+               "--cache-dir", path.join(tmp, "cache"), "--shutdown-timeout", "30"]
+    return subprocess.Popen(command + list(arguments), cwd=tmp, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True,
+                            env=dict(os.environ, STUB_SHUTDOWN=str(shutdown)))
+
+
+def run_test(tmp, *arguments):
+    """Run qemu_install_test.py with the stubs, return (exit code, output)."""
+    with start_test(tmp, *arguments) as process:
+        output = process.stdout.read()
+    return process.returncode, output
+
+
+def check():
+    """Return a list of problems found running the stubs."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        write(path.join(tmp, "qemu"), QEMU_STUB, 0o755)
+        write(path.join(tmp, "qemu-img"), QEMU_IMG_STUB, 0o755)
+        write(path.join(tmp, "a.iso"), "a")
+        write(path.join(tmp, "b.iso"), "b")
+
+        for step in ("install", "cached"):
+            code, output = run_test(tmp, "a.iso", "b.iso", "--runs", "2", "--jobs", "4")
+            installs = output.count("Installing system from")
+            expected = 2 if step == "install" else 0
+            if code != 0 or output.count(" PASS ") != 4 or installs != expected:
+                problems.append("{} run: exit {}, {} installs, expected {}:\n{}".format(
+                    step, code, installs, expected, output))
+
+        with start_test(tmp, "a.iso", shutdown=5) as running:
+            # Give it the time to boot the cached image
+            time.sleep(1)
+            code, output = run_test(tmp, "a.iso", "--reinstall")
+            if code != 0 or "Saving installation" not in output:
+                problems.append("reinstall run: exit {}:\n{}".format(code, output))
+            if running.poll() is not None:
+                problems.append("reinstall run waited for the run booting the old image")
+            running.stdout.read()
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda _: run_test(tmp, "a.iso", "--runs", "3", "--jobs", "3"),
+                                    range(2)))
+        ports = re.findall(r"ssh port (\d+) vnc :(\d+)", "".join(output for _, output in results))
+        if len(ports) != 6 or len({port for port, _ in ports}) != 6 or len({vnc for _, vnc in ports}) != 6:
+            problems.append("concurrent runs share ports or displays: {}".format(ports))
+        for code, output in results:
+            if code != 0:
+                problems.append("concurrent run: exit {}:\n{}".format(code, output))
+
+        code, output = run_test(tmp, "a.iso", "legacy.img", "--no-cache", "--keep")
+        if code != 0 or "deprecated, use --disk legacy.img" not in output or \
+                not path.isfile(path.join(tmp, "legacy.img")):
+            problems.append("positional disk: exit {}:\n{}".format(code, output))
+    return problems
+
+
+class BaselineStreamToLogger(object):
+    """StreamToLogger as it was before it kept only the partial line."""
+    def __init__(self, logger, log_level=logging.INFO):
+        self.logger = logger
+        self.log_level = log_level
+        self.linebuf = b''
+        self.ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
+
+    def write(self, buf):
+        self.linebuf += buf
+        while b'\n' in self.linebuf:
+            f = self.linebuf.split(b'\n', 1)
+            if len(f) == 2:
+                self.logger.debug(self.ansi_escape.sub('', f[0].decode(errors="replace").rstrip()))
+                self.linebuf = f[1]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def load_stream_to_logger():
+    """Return the StreamToLogger class of qemu_install_test.py."""
+    # Importing the script would run it, only the class is compiled
+    filename = path.join(HERE, "qemu_install_test.py")
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    node = next(node for node in tree.body
+                if isinstance(node, ast.ClassDef) and node.name == "StreamToLogger")
+    namespace = {"logging": logging, "re": re}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), filename, "exec"), namespace)
+    return namespace["StreamToLogger"]
+
+
+class LineCounter(logging.Handler):
+    """Count the DEBUG lines reaching a logger."""
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.lines = 0
+
+    def emit(self, record):
+        self.lines += 1
+
+
+def console_dump(size):
+    """Return about size bytes of boot console output with colour escapes."""
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        if i % 20 == 0:
+            line = "[  \x1b[0;32mOK  \x1b[0m] Started Service number {}.\r\n".format(i)
+        else:
+            line = "[{:>5}.{:06d}] pci 0000:00:{:02x}.0: reg 0x10: [mem 0xfe{:06x}-0xfe{:06x}]\r\n".format(
+                i // 1000, i % 1000 * 997, i % 32, i * 16, i * 16 + 15)
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return "".join(lines).encode()
+
+
+def run_console(args):
+    """Time StreamToLogger on a synthetic console dump."""
+    dump = console_dump(int(args.console * 1e6))
+    chunked = [dump[i:i + 4096] for i in range(0, len(dump), 4096)]
+    stream_to_logger = load_stream_to_logger()
+    log = logging.getLogger("console")
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    counter = LineCounter()
+    log.addHandler(counter)
+
+    def feed(cls, chunks):
+        stl = cls(log)
+        for chunk in chunks:
+            stl.write(chunk)
+        stl.close()
+
+    print("{} bytes, {} lines, best of {}".format(len(dump), dump.count(b"\n"), args.repeat))
+    for name, cls in (("StreamToLogger", stream_to_logger), ("baseline", BaselineStreamToLogger)):
+        for label, chunks in (("one chunk", [dump]), ("4k chunks", chunked)):
+            counter.lines = 0
+            feed(cls, chunks)
+            if counter.lines != dump.count(b"\n"):
+                raise AssertionError("{} logged {} lines".format(name, counter.lines))
+            times = []
+            for _ in range(args.repeat):
+                start = time.monotonic()
+                feed(cls, chunks)
+                times.append(time.monotonic() - start)
+            print("{:<16} {:<10} {:>9.1f} ms".format(name, label, min(times) * 1000))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check qemu_install_test.py with stub QEMU binaries.")
+    parser.add_argument("--console", type=float, nargs="?", const=1.3, metavar="MB",
+                        help="time StreamToLogger on a console dump of MB megabytes, 1.3 if not given")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of runs to take the best time of")
+    args = parser.parse_args()
+
+    if args.console:
+        run_console(args)
+        sys.exit(0)
+
+    problems = check()
+    for problem in problems:
+        print(problem)
+    print("{} problems".format(len(problems)))
+    sys.exit(1 if problems else 0)
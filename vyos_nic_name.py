@@ -1,15 +1,48 @@
 #!/usr/bin/env python3
 """VyOS Ethernet nic nameing system."""
 
+import atexit
 import fcntl
-import re
-import traceback
+import marshal
+import os
 import sys
-from subprocess import check_output, CalledProcessError
-from vyos.configtree import ConfigTree
-from os import path
-from time import sleep
-import errno
+from bisect import bisect_right
+from os import path, stat
+from time import monotonic, sleep
+# re, subprocess, threading, traceback and vyos.configtree are imported where
+# they are used, a MAC found in the persist file needs none of them
+
+# Prefix for every path below, lets the benchmark run against a fake root
+ROOT = os.environ.get("VYOS_NIC_NAME_ROOT", "")
+PERSIST_FILE = ROOT + "/config/interface-names.persist"
+TMP_PERSIST_FILE = ROOT + "/run/udev/interface-names.tmp"
+CONFIG_BOOT_FILE = ROOT + "/config/config.boot"
+RULES_FILE = ROOT + "/config/interface-names.rules"
+LOCK_FILE = ROOT + "/run/udev/ifname.lock"
+# Log to the kernel log unless redirected, stdout is reserved for udev
+KMSG_FILE = os.environ.get("VYOS_NIC_NAME_LOG", "/dev/kmsg")
+# /dev/kmsg rejects records longer than LOG_LINE_MAX (992 bytes) with EINVAL
+KMSG_RECORD_SIZE = 976
+# Seconds to wait for the naming lock, udev kills events after 180 seconds.
+# QUERY_TIMEOUT of vyos_nic_name_client.py has to stay well above it
+LOCK_TIMEOUT = 60
+CONFIG_BOOT_CACHE_FILE = ROOT + "/run/udev/config.boot.hwids.cache"
+PENDING_RENAMES_FILE = ROOT + "/run/udev/ifname.pending"
+PLAN_FILE = ROOT + "/run/udev/ifname.plan"
+SYSFS_ROOT = ROOT + "/sys"
+SYSFS_NET = path.join(SYSFS_ROOT, "class/net")
+BIOSDEVNAME_CACHE_FILE = ROOT + "/run/udev/biosdevname.cache"
+BIOSDEVNAME = ROOT + "/sbin/biosdevname"
+# Log one line with the time spent in each naming phase per event
+TIMING = os.environ.get("VYOS_NIC_NAME_TIMING") == "1"
+# Max seconds to wait for renames handed to udev by earlier events
+RENAME_WAIT_TIMEOUT = 1.0
+
+# Compact the persist journal every time it grows this many bytes
+JOURNAL_COMPACT_SIZE = 64 * 1024
+# Bump when the layout of compiled cache files changes
+CACHE_VERSION = 2
+
 """Pre boot workflow
 NB: All debuging needs to be returned to stderr or anoter logging location,
     this is because stdout is used to return data to UDEV
@@ -51,7 +84,11 @@ def vyos_config_loaded():
     """Check if VyOS is fully booted."""
     # When this is False, router is booting and we could also be in ro-root
     # If this directory exists the router have loaded its configuration
-    return path.isdir("/opt/vyatta/config/active/interfaces")
+    return path.isdir(ROOT + "/opt/vyatta/config/active/interfaces")
+
+
+class LockTimeout(Exception):
+    """The lock was not aquired before the deadline."""
 
 
 class Locker:
@@ -59,27 +96,77 @@ class Locker:
 
     # maybe also look at :
     # https://github.com/derpston/python-simpleflock/blob/master/src/simpleflock.py
-    def __init__(self, filename):
-        """Initiate a file lock."""
+    def __init__(self, filename, timeout=None, log_stats=False):
+        """Initiate a file lock, timeout=None waits forever."""
         self._filename = filename
+        self._timeout = timeout
+        self._log_stats = log_stats
         self._f = None
+        self._locked_at = None
+        self.wait_time = 0.0
 
     def wait_and_lock(self):
         """Try to lock a file and wait until lock is aquired."""
-        # Waits forever to get a lock on the lockfile
+        # Waits in the kernel until the lock is released by the holder
+        # LockTimeout is raised if the lock is not aquired within timeout
         # If an unrelated error occures a exception is raised
-        self._f = open(self._filename, "w")
-        while True:
-            try:
-                fcntl.flock(self._filename, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return
-            except IOError as e:
-                if e.errno == errno.EAGAIN:
-                    # Do not raise error when waiting to aquire lock
-                    sleep(0.1)
-                else:
-                    # Raise on all unrelated errors
+        start = monotonic()
+        f = open(self._filename, "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Lock is held by someone else, wait for it
+            if self._timeout is None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                except BaseException:
+                    f.close()
                     raise
+            else:
+                # f belongs to the waiter thread from here, it closes f when
+                # the wait fails so the fd is never closed under its flock
+                self._wait_with_timeout(f)
+        except BaseException:
+            f.close()
+            raise
+        self._f = f
+        self._locked_at = monotonic()
+        self.wait_time = self._locked_at - start
+
+    def _wait_with_timeout(self, f):
+        """Block on the lock in a waiter thread, giving up after timeout."""
+        # A blocking flock can not be cancelled, so when we give up the waiter
+        # thread is left behind and closes f, releasing the lock, as soon as
+        # flock returns. Only the waiter closes f on failure, a close here
+        # could free the fd number for another open while flock still uses it.
+        import threading
+
+        guard = threading.Lock()
+        done = threading.Event()
+        state = {"abandoned": False, "error": None}
+
+        def waiter():
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except OSError as e:
+                state["error"] = e
+            with guard:
+                if state["abandoned"] or state["error"]:
+                    f.close()
+                done.set()
+
+        threading.Thread(target=waiter, daemon=True).start()
+        try:
+            done.wait(self._timeout)
+        finally:
+            # Also when interrupted while waiting
+            with guard:
+                state["abandoned"] = not done.is_set()
+        if state["abandoned"]:
+            raise LockTimeout(
+                "Unable to lock {} within {} seconds".format(self._filename, self._timeout))
+        if state["error"]:
+            raise state["error"]
 
     def unlock(self):
         """Unlock the file."""
@@ -87,10 +174,16 @@ class Locker:
             fcntl.flock(self._f, fcntl.LOCK_UN)
             self._f.close()
             self._f = None
+            if self._log_stats:
+                log_to_dmesg("Lock {}: waited {:.1f} ms, held {:.1f} ms".format(
+                    self._filename,
+                    self.wait_time * 1000,
+                    (monotonic() - self._locked_at) * 1000), key="lock-stats")
 
     def __enter__(self):
         """Lock file in with loop."""
         self.wait_and_lock()
+        return self
 
     def __exit__(self, type, value, traceback):
         """With loop exit."""
@@ -101,8 +194,212 @@ class Locker:
         self.unlock()
 
 
+class _Patterns:
+    """Regular expressions, compiled together the first time one is used."""
+
+    _sources = {
+        "mac_chars": r'^[0-9a-fA-F:\-\.]+$',
+        "mac_separators": r'[:\-\.]',
+        "quoted_string": r'"(?:[^"\\]|\\.)*"',
+        # A valid entry line, anything else is handled by parse_persistant_names_line
+        "entry_line": r'^\s*([a-zA-Z0-9\-\.\_]{1,16})\s*=\s*([a-zA-Z0-9\-\.\_\:]+)\s*$',
+        "interface_name": r'^[a-zA-Z0-9\-\.\_]+$',
+        "mac_field": r'^[a-zA-Z0-9\-\.\_\:]+$',
+        "trailing_digits": r'\d+$',
+        "prefix": r'^[a-z]{1,10}$',
+    }
+
+    def __getattr__(self, name):
+        """Compile all patterns, later lookups find them as attributes."""
+        if name not in self._sources:
+            raise AttributeError(name)
+        import re
+
+        for key, pattern in self._sources.items():
+            setattr(self, key, re.compile(pattern))
+        return self.__dict__[name]
+
+
+_re = _Patterns()
+_hex_digits = frozenset("0123456789abcdef")
+
+
+def format_exc():
+    """Return the current exception and traceback as a string."""
+    import traceback
+
+    return traceback.format_exc()
+
+
+def normalize_mac(mac):
+    """Return a MAC address in lower case colon separated notation."""
+    # 00-11-22-33-44-55, 0011.2233.4455 and 00:11:22:33:44:55 are all the same
+    # address, anything that is not a 48 bit MAC is only lower cased
+    mac = mac.lower()
+    if len(mac) == 17 and mac[2::3] == ":::::" and _hex_digits.issuperset(mac.replace(":", "")):
+        # Already normalized, the common case
+        return mac
+    if _re.mac_chars.match(mac):
+        digits = _re.mac_separators.sub("", mac)
+        if len(digits) == 12:
+            return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+    return mac
+
+
+class HwidIndex:
+    """Interface name to MAC and MAC to interface name index."""
+
+    def __init__(self, interfaces=None):
+        """Build index from a dict of interface names and MAC addresses."""
+        self.by_name = dict()
+        self.by_mac = dict()
+        self._allocators = dict()
+        if interfaces:
+            self.update(interfaces)
+
+    @classmethod
+    def from_tables(cls, by_name, by_mac):
+        """Create index from already normalized tables."""
+        index = cls()
+        index.by_name = by_name
+        index.by_mac = by_mac
+        return index
+
+    def tables(self):
+        """Return the index tables, used for the compiled cache."""
+        return self.by_name, self.by_mac
+
+    def copy(self):
+        """Return a copy that can be updated without touching this index."""
+        index = HwidIndex.from_tables(dict(self.by_name), dict(self.by_mac))
+        index._allocators = {p: a.copy() for p, a in self._allocators.items()}
+        return index
+
+    def allocator(self, prefix="eth"):
+        """Return the IndexAllocator for names in use with prefix."""
+        # Built on first use and kept up to date by add()
+        if prefix not in self._allocators:
+            self._allocators[prefix] = IndexAllocator(prefix, self.by_name)
+        return self._allocators[prefix]
+
+    def add(self, name, mac):
+        """Add or replace an interface."""
+        mac = normalize_mac(mac)
+        old_mac = self.by_name.get(name)
+        if old_mac is not None and self.by_mac.get(old_mac) == name:
+            del self.by_mac[old_mac]
+        self.by_name[name] = mac
+        # When a MAC is listed more than once the first interface wins
+        self.by_mac.setdefault(mac, name)
+        for allocator in self._allocators.values():
+            allocator.add_name(name)
+
+    def update(self, interfaces):
+        """Add all interfaces from a dict of interface names and MAC addresses."""
+        for name, mac in interfaces.items():
+            self.add(name, mac)
+
+    def name(self, mac):
+        """Return the interface name using mac, or None."""
+        return self.by_mac.get(normalize_mac(mac))
+
+    def __contains__(self, name):
+        """Check if an interface name is in use."""
+        return name in self.by_name
+
+    def __len__(self):
+        """Number of interfaces in the index."""
+        return len(self.by_name)
+
+
+class IndexAllocator:
+    """Find the lowest free index for names like eth0, eth1, ..."""
+
+    def __init__(self, prefix="eth", names=(), ceiling=10000):
+        """Collect the indices used by names, indices stop below ceiling."""
+        # Used indices are kept as sorted, merged runs [start, end], so a
+        # lookup is one bisect no matter how many names are in use
+        self.prefix = prefix
+        self.ceiling = ceiling
+        self._starts = []
+        self._ends = []
+        for index in sorted(set(i for i in map(self.index, names) if i is not None)):
+            if self._ends and self._ends[-1] + 1 == index:
+                self._ends[-1] = index
+            else:
+                self._starts.append(index)
+                self._ends.append(index)
+
+    def copy(self):
+        """Return a copy that can be updated without touching this allocator."""
+        allocator = IndexAllocator(self.prefix, ceiling=self.ceiling)
+        allocator._starts = list(self._starts)
+        allocator._ends = list(self._ends)
+        return allocator
+
+    def index(self, name):
+        """Return the index of a name, or None if it is not prefix<index>."""
+        if not name.startswith(self.prefix):
+            return None
+        digits = name[len(self.prefix):]
+        if not (digits.isascii() and digits.isdigit()):
+            return None
+        if len(digits) > 1 and digits[0] == "0":
+            # eth01 is not eth1
+            return None
+        return int(digits)
+
+    def name(self, index):
+        """Return the name for an index."""
+        return "{}{}".format(self.prefix, index)
+
+    def find(self, seed=0):
+        """Return the lowest free index >= seed, or None."""
+        i = bisect_right(self._starts, seed) - 1
+        if i >= 0 and self._ends[i] >= seed:
+            # seed is in a run of used indices, the one after it is free
+            seed = self._ends[i] + 1
+        return seed if seed < self.ceiling else None
+
+    def add(self, index):
+        """Mark an index as used."""
+        i = bisect_right(self._starts, index) - 1
+        if i >= 0 and self._ends[i] >= index:
+            # Already used
+            return
+        joins_left = i >= 0 and self._ends[i] + 1 == index
+        joins_right = i + 1 < len(self._starts) and self._starts[i + 1] - 1 == index
+        if joins_left and joins_right:
+            self._ends[i] = self._ends[i + 1]
+            del self._starts[i + 1]
+            del self._ends[i + 1]
+        elif joins_left:
+            self._ends[i] = index
+        elif joins_right:
+            self._starts[i + 1] = index
+        else:
+            self._starts.insert(i + 1, index)
+            self._ends.insert(i + 1, index)
+
+    def add_name(self, name):
+        """Mark the index of a name as used, other names are ignored."""
+        index = self.index(name)
+        if index is not None:
+            self.add(index)
+
+    def allocate(self, seed=0):
+        """Return the lowest free name with index >= seed and mark it used, or None."""
+        index = self.find(seed)
+        if index is None:
+            return None
+        self.add(index)
+        return self.name(index)
+
+
 def read_hwids_from_configfile(filename):
     """Read a vyos file and return all ethernet hw-id fields."""
+    from vyos.configtree import ConfigTree
+
     interfaces = dict()
     with open(filename, "r") as f:
         config = ConfigTree(f.read())
@@ -117,89 +414,830 @@ def read_hwids_from_configfile(filename):
     return interfaces
 
 
-def log_to_dmesg(message):
+class _AmbiguousConfig(Exception):
+    """Config file syntax the fast scanner does not understand."""
+
+
+def _scan_hwids(f):
+    """Scan an open vyos file for interfaces ethernet * hw-id."""
+    interfaces = dict()
+    # Only the names of the first two levels are tracked, every other node is
+    # skipped by counting braces
+    depth = 0
+    section = [None, None]
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("/*") and line.endswith("*/") and line.count("*/") == 1:
+            # Single line comment
+            continue
+
+        bare = line
+        if '"' in bare:
+            bare = _re.quoted_string.sub('""', bare)
+            if '"' in bare.replace('""', ""):
+                # Multi line string
+                raise _AmbiguousConfig()
+        if "/*" in bare or "*/" in bare:
+            raise _AmbiguousConfig()
+
+        if bare.endswith("{"):
+            if "{" in bare[:-1] or "}" in bare:
+                raise _AmbiguousConfig()
+            if depth < 2:
+                section[depth] = bare[:-1].strip()
+            depth += 1
+        elif bare == "}":
+            depth -= 1
+            if depth < 0:
+                raise _AmbiguousConfig()
+            if depth == 0 and section[0] == "interfaces":
+                # There is only one interfaces section, skip the rest of the file
+                return interfaces
+        elif "{" in bare or "}" in bare:
+            raise _AmbiguousConfig()
+        elif depth == 2 and section[0] == "interfaces" and line.startswith("hw-id "):
+            node = section[1].split()
+            if len(node) != 2 or node[0] != "ethernet":
+                continue
+            interfaces[node[1]] = line[6:].strip().strip('"')
+
+    if depth != 0:
+        raise _AmbiguousConfig()
+    return interfaces
+
+
+def scan_hwids_from_configfile(filename):
+    """Read all ethernet hw-id fields from a vyos file without a ConfigTree."""
+    # Falls back to a full ConfigTree parse when the file is not understood
+    try:
+        with open(filename, "r", errors="replace") as f:
+            return _scan_hwids(f)
+    except _AmbiguousConfig:
+        log_to_dmesg(
+            "Unable to scan {} for hw-id, using full config parser".format(filename),
+            KmsgLogger.NOTICE)
+    return read_hwids_from_configfile(filename)
+
+
+def read_hwids_index_from_configfile(filename):
+    """Read a vyos file and return an index of all ethernet hw-id fields."""
+    # The result is cached in /run for the rest of the boot
+    return HwidIndex(read_compiled(scan_hwids_from_configfile,
+                                   filename,
+                                   CONFIG_BOOT_CACHE_FILE))
+
+
+# Parsed files kept between calls, keyed on filename.
+# Only useful for long lived processes like vyos_nic_named.py
+_file_cache = dict()
+
+
+def read_cached(reader, filename):
+    """Return reader(filename), reusing the last result while the file is unchanged."""
+    st = stat(filename)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _file_cache.get(filename)
+    if cached and cached[0] == reader and cached[1] == key:
+        return cached[2]
+    data = reader(filename)
+    _file_cache[filename] = (reader, key, data)
+    return data
+
+
+def read_compiled(reader, filename, cache_filename):
+    """Return reader(filename), reusing a compiled cache file while the file is unchanged."""
+    # The result of reader must be marshal-able
+    st = stat(filename)
+    key = (CACHE_VERSION, reader.__name__, st.st_ino, st.st_size, st.st_mtime_ns)
+    try:
+        with open(cache_filename, "rb") as f:
+            cached_key, data = marshal.loads(f.read())
+        if cached_key == key:
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        # Missing or broken cache, rebuild it
+        pass
+
+    data = reader(filename)
+    try:
+        tmp_filename = "{}.{}".format(cache_filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            marshal.dump((key, data), f)
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        # Read only filesystem, we just have to parse the file next time
+        pass
+    return data
+
+
+class KmsgLogger:
+    """Kernel log writer keeping /dev/kmsg open between messages."""
+
+    # Log levels, same values as the kernel uses
+    ERR = 3
+    WARNING = 4
+    NOTICE = 5
+    INFO = 6
+    DEBUG = 7
+
+    def __init__(self, filename=KMSG_FILE, level=INFO, sink=None,
+                 rate_limit=10, rate_interval=5.0, max_keys=256):
+        """Log to filename, or append records to the list sink."""
+        # At most rate_limit messages per key are written every rate_interval
+        # seconds, the rest are counted and reported when the interval ends.
+        # Messages without a key are their own key, so the daemon would keep
+        # a window for every message, windows that ended are forgotten and
+        # at most max_keys are kept
+        self._filename = filename
+        self._sink = sink
+        self._fd = None
+        self.level = level
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.max_keys = max_keys
+        # Windows in the order they started, the oldest first
+        self._keys = dict()
+        self._last = None
+        self._repeated = 0
+
+    def _write(self, level, message):
+        """Write one record."""
+        record = "<{}>vyos_nic_name: {}".format(level, message)
+        if self._sink is not None:
+            self._sink.append(record)
+            return
+        try:
+            if self._fd is None:
+                self._fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            data = record.encode(errors="replace")
+            if len(data) >= KMSG_RECORD_SIZE:
+                # A rejected record would be lost completely
+                data = data[:KMSG_RECORD_SIZE - 4] + b"..."
+            os.write(self._fd, data + b"\n")
+        except OSError:
+            # Logging is best effort, never fail naming because of it
+            pass
+
+    def record(self, message, level=INFO):
+        """Log a message without rate limiting or coalescing."""
+        if level <= self.level:
+            self._write(level, message)
+
+    def _flush_repeated(self):
+        """Report coalesced repeats of the last message."""
+        if self._repeated:
+            self._write(self._last[0], "last message repeated {} times".format(self._repeated))
+            self._repeated = 0
+
+    def log(self, message, level=INFO, key=None):
+        """Log a message, key groups messages for rate limiting."""
+        if level > self.level:
+            return
+
+        if (level, message) == self._last:
+            # Coalesce identical messages
+            self._repeated += 1
+            return
+        self._flush_repeated()
+        self._last = (level, message)
+
+        now = monotonic()
+        key = key or message
+        window = self._keys.get(key)
+        if window is None or now - window[0] >= self.rate_interval:
+            if window and window[2]:
+                self._write(level, "{} messages suppressed".format(window[2]))
+            # Moved to the end, it is the newest window now
+            self._keys.pop(key, None)
+            self._prune(now)
+            window = self._keys[key] = [now, 0, 0]
+        window[1] += 1
+        if window[1] > self.rate_limit:
+            window[2] += 1
+            return
+        self._write(level, message)
+
+    def _prune(self, now):
+        """Forget windows that ended, and the oldest ones to make room for one more."""
+        while self._keys:
+            key = next(iter(self._keys))
+            window = self._keys[key]
+            if now - window[0] < self.rate_interval and len(self._keys) < self.max_keys:
+                break
+            if window[2]:
+                self._write(self.WARNING, "{} messages suppressed".format(window[2]))
+            del self._keys[key]
+
+    def flush(self):
+        """Write pending repeat and suppression reports."""
+        self._flush_repeated()
+        for window in self._keys.values():
+            if window[2]:
+                self._write(self.WARNING, "{} messages suppressed".format(window[2]))
+                window[2] = 0
+
+    def close(self):
+        """Flush and close the log file."""
+        self.flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+logger = KmsgLogger()
+atexit.register(logger.close)
+
+
+def log_to_dmesg(message, level=KmsgLogger.INFO, key=None):
     """Log to dmesg/kmsg kernel log."""
-    with open("/dev/kmsg", "w") as f:
-        f.write("vyos_nic_name: {}".format(message))
+    logger.log(message, level, key)
+
+
+class PhaseTimer:
+    """Time spent in the phases of one naming event."""
+
+    def __init__(self, enabled=TIMING):
+        """Start timing, a disabled timer does nothing."""
+        self.enabled = enabled
+        self.phases = dict()
+        self._start = self._last = monotonic() if enabled else 0
+
+    def mark(self, phase):
+        """Add the time since the previous mark to phase."""
+        if self.enabled:
+            now = monotonic()
+            self.phases[phase] = self.phases.get(phase, 0) + now - self._last
+            self._last = now
+
+    def emit(self, if_name, name):
+        """Log the timings as one key=value line."""
+        if not self.enabled:
+            return
+        fields = ["timing if={} name={} total_ms={:.3f}".format(
+            if_name, name or "-", (monotonic() - self._start) * 1000)]
+        for phase, seconds in self.phases.items():
+            fields.append("{}_ms={:.3f}".format(phase, seconds * 1000))
+        logger.record(" ".join(fields))
+
+
+_no_timer = PhaseTimer(enabled=False)
+
+
+# Max number of bad lines reported from one file
+MAX_REPORTED_LINES = 20
+# Room left in a kmsg record for the level and tag
+KMSG_MESSAGE_SIZE = KMSG_RECORD_SIZE - 32
+
+
+def join_messages(prefix, items, size=KMSG_MESSAGE_SIZE):
+    """Join items into as few messages starting with prefix as fit in size bytes."""
+    messages = []
+    current = []
+    length = len(prefix.encode(errors="replace"))
+    for item in items:
+        item_length = len(item.encode(errors="replace")) + 2
+        if current and length + item_length > size:
+            messages.append(prefix + "; ".join(current))
+            current = []
+            length = len(prefix.encode(errors="replace"))
+        current.append(item)
+        length += item_length
+    if current:
+        messages.append(prefix + "; ".join(current))
+    return messages
+
+
+def parse_persistant_names_line(line):
+    """Parse one line of a persistant interface names file."""
+    # Returns (interface, mac, None) for an entry, (None, None, None) for
+    # empty lines and comments and (None, None, message) for illegal lines
+    line = line.strip()
+
+    if not line:
+        # Ignore empty lines
+        return None, None, None
+
+    if line.startswith("#") or line.startswith(";"):
+        # Ignore comments
+        return None, None, None
+
+    entry = line.split("=", 2)
+    if len(entry) != 2:
+        # Ignore lines not following the syntax
+        return None, None, "Illegal entry found in config file, ignoring"
+
+    intf = entry[0].strip()
+    mac = entry[1].strip()
+    if not intf:
+        # Empty interface name
+        return None, None, "Empty interfacename is found, ignoring"
+
+    if len(intf) > 16:
+        # Interface name to long
+        return None, None, "Interface name is to to long. Max length is 16 chars, ignoring"
+
+    if not _re.interface_name.match(intf):
+        # Interface with illegal character
+        return None, None, "Interface name contains illegal characters. Only a-z 0-9 - _ . is allowed, ignoring"
+
+    if not mac:
+        # Mac field is empty
+        return None, None, "MAC value can not be empty, ignoring"
+
+    if not _re.mac_field.match(mac):
+        # Interface with illegal character
+        return None, None, "Interface name contains illegal characters in MAC field. Only a-z 0-9 - _ . : is allowed, ignoring"
+
+    return intf, mac, None
+
+
+def torn_persistant_names_tail(filename):
+    """Return the length of a last line left unfinished by a killed save, 0 if none."""
+    # save_persistant_names() records where its append starts and removes the
+    # record once the append is on disk. Only an unterminated last line in a
+    # recorded append is cut short by a killed writer, a write to a file can
+    # stop at a page boundary. Other last lines without a newline, like after
+    # a hand edit, are kept.
+    try:
+        with open(filename + ".append", "r") as f:
+            start = int(f.read())
+    except (OSError, ValueError):
+        return 0
+    with open(filename, "rb") as f:
+        f.seek(start)
+        appended = f.read()
+    if not appended or appended.endswith(b"\n"):
+        return 0
+    return len(appended) - appended.rfind(b"\n") - 1
 
 
 def read_persistant_names_file(filename):
     """Read persistant interface names file."""
+    # The file is a journal, when an interface is listed more than once the
+    # last entry wins. Problems are reported in as few kmsg messages as fit.
     interfaces = dict()
+    errors = []
+    entry_line = _re.entry_line.match
     with open(filename, "r", errors="replace") as f:
-        for _l in enumerate(f.readlines()):
-            index = _l[0] + 1
-            line = _l[1].strip()
-
-            if not line:
-                # Ignore empty lines
+        for index, line in enumerate(f, 1):
+            if line[-1:] != "\n" and torn_persistant_names_tail(filename):
+                # Cut short by a killed save, the next save removes it
+                break
+            m = entry_line(line)
+            if m:
+                interfaces[m.group(1)] = m.group(2)
                 continue
+            # Empty line, comment or illegal entry
+            intf, mac, error = parse_persistant_names_line(line)
+            if error:
+                errors.append("{}: {}".format(index, error))
+            elif intf:
+                interfaces[intf] = mac
+
+    if errors:
+        if len(errors) > MAX_REPORTED_LINES:
+            errors[MAX_REPORTED_LINES:] = ["{} more".format(len(errors) - MAX_REPORTED_LINES)]
+        # Split in records /dev/kmsg accepts
+        for message in join_messages("{}: ".format(filename), errors):
+            log_to_dmesg(message, KmsgLogger.WARNING, key=filename)
+    return interfaces
 
-            if line.startswith("#") or line.startswith(";"):
-                # Ignore comments
-                continue
 
-            entry = line.split("=", 2)
-            if len(entry) != 2:
-                # Ignore lines not following the syntax
-                log_to_dmesg(
-                    "{}: Illegal entry found in config file, ignoring".format(index))
-                continue
+def _index_persistant_names_file(filename):
+    """Read persistant interface names file into index tables."""
+    return HwidIndex(read_persistant_names_file(filename)).tables()
 
-            intf = entry[0].strip()
-            mac = entry[1].strip()
-            if not intf:
-                # Empty interface name
-                log_to_dmesg(
-                    "{}: Empty interfacename is found, ignoring".format(index))
-                continue
 
-            if len(intf) > 16:
-                # Interface name to long
-                log_to_dmesg(
-                    "{}: Interface name is to to long. Max length is 16 chars, ignoring".format(index))
-                continue
+def read_persistant_names_index(filename):
+    """Read persistant interface names file as an index, using the compiled cache."""
+    return HwidIndex.from_tables(*read_compiled(_index_persistant_names_file,
+                                                filename,
+                                                filename + ".cache"))
 
-            if not re.match(r'^[a-zA-Z0-9\-\.\_]+$', intf):
-                # Interface with illegal character
-                log_to_dmesg(
-                    "{}: Interface name contains illegal characters. Only a-z 0-9 - _ . is allowed, ignoring".format(index))
-                continue
 
-            if not mac:
-                # Mac field is empty
-                log_to_dmesg(
-                    "{}: MAC value can not be empty".format(index))
+def read_names_index(filename):
+    """Read persistant interface names file as an index, without the compiled cache."""
+    return HwidIndex(read_persistant_names_file(filename))
 
-            if not re.match(r'^[a-zA-Z0-9\-\.\_\:]+$', mac):
-                # Interface with illegal character
-                log_to_dmesg(
-                    "{}: Interface name contains illegal characters in MAC field. Only a-z 0-9 - _ . : is allowed, ignoring".format(index))
-                continue
 
-            interfaces[intf] = mac
-    return interfaces
+def _fsync_dir(dirname):
+    """Make a rename or file creation in a directory durable."""
+    fd = os.open(dirname or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_persistant_names(filename, entries):
+    """Save a list of (interface, mac) to persistent name file in one write."""
+    # The file is an append only journal, entries are added with a single
+    # O_APPEND write and fsync so existing entries are never rewritten in
+    # place. Later entries replace earlier ones for the same interface.
+    data = "".join("{} = {}\n".format(i, m) for i, m in entries).encode()
+    created = not path.exists(filename)
+    fd = os.open(filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        torn = torn_persistant_names_tail(filename)
+        if torn:
+            size -= torn
+            os.ftruncate(fd, size)
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            # Last line was written without a line ending
+            data = b"\n" + data
+        # Where this append starts, removed when the append is on disk
+        with open(filename + ".append", "w") as f:
+            f.write(str(size))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        os.unlink(filename + ".append")
+    finally:
+        os.close(fd)
+    if created:
+        _fsync_dir(path.dirname(filename))
+
+    # Compact each time the journal grows past another JOURNAL_COMPACT_SIZE
+    if size // JOURNAL_COMPACT_SIZE != (size + len(data)) // JOURNAL_COMPACT_SIZE:
+        try:
+            compact_persistant_names_file(filename)
+        except OSError:
+            log_to_dmesg(
+                "Exception compacting {}: \n{}".format(filename, format_exc()), KmsgLogger.ERR)
+
+
+def compact_persistant_names_file(filename):
+    """Remove replaced entries from persistent name file."""
+    # Comments and illegal lines are kept, the new file is written to a temp
+    # file and renamed over the old one so a crash leaves either file intact
+    with open(filename, "r", errors="replace") as f:
+        lines = f.readlines()
+
+    names = [parse_persistant_names_line(l)[0] for l in lines]
+    last = {intf: i for i, intf in enumerate(names) if intf}
+    keep = [l for i, l in enumerate(lines) if not names[i] or last[names[i]] == i]
+    if len(keep) == len(lines):
+        return
+
+    # Always the same temp name, so a killed compaction leaves no litter
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        for l in keep:
+            f.write(l.rstrip("\r\n"))
+            f.write("\n")
+        f.flush()
+        os.fchmod(f.fileno(), stat(filename).st_mode & 0o7777)
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    _fsync_dir(path.dirname(filename))
 
 
 def save_persistant_names_file(filename, interface, mac):
     """Save interface to persistent name file."""
+    save_persistant_names(filename, [(interface, mac)])
+
+
+def _ifindex(ifname):
+    """Return the ifindex of an interface as a string, or None."""
     try:
-        with open(filename, "r", errors="replace") as f:
-            lines = f.readlines()
-            if len(lines) > 0:
-                if len(lines[-1].strip()) == 0:
-                    lines.pop()
+        with open(path.join(SYSFS_NET, ifname, "ifindex")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
 
-            lines.append("{} = {}".format(interface, mac))
-            f.seek(0)
-    except Exception:
+
+def record_pending_rename(if_name, new_name):
+    """Remember a name handed to udev until the rename is seen in sysfs."""
+    ifindex = _ifindex(if_name)
+    if ifindex is None:
+        return
+    with open(PENDING_RENAMES_FILE, "a") as f:
+        f.write("{} {} {}\n".format(ifindex, if_name, new_name))
+
+
+def _rename_done(ifindex, if_name, new_name):
+    """Check if a pending rename is done, or can never be done."""
+    # Done when the new name is on the device, the old name no longer being
+    # on the device means it is renamed to something else or removed
+    return _ifindex(new_name) == ifindex or _ifindex(if_name) != ifindex
+
+
+def wait_for_pending_renames(timeout=RENAME_WAIT_TIMEOUT):
+    """Wait until renames ordered by previous invocations are completed."""
+    # Returns immediately when nothing is pending
+    try:
+        with open(PENDING_RENAMES_FILE, "r") as f:
+            pending = [l.split() for l in f]
+    except FileNotFoundError:
+        return
+
+    pending = [p for p in pending if len(p) == 3]
+    deadline = monotonic() + timeout
+    delay = 0.005
+    while True:
+        pending = [p for p in pending if not _rename_done(*p)]
+        if not pending or monotonic() >= deadline:
+            break
+        sleep(min(delay, max(deadline - monotonic(), 0)))
+        delay = min(delay * 2, 0.05)
+
+    for p in pending:
         log_to_dmesg(
-            "save_persistant_names_file: Exception: {}".format(traceback.format_exc()))
+            "{}: rename to {} did not complete in time".format(p[1], p[2]),
+            KmsgLogger.WARNING, key="rename-timeout")
+    # Everything is either done or given up on
+    try:
+        os.remove(PENDING_RENAMES_FILE)
+    except FileNotFoundError:
+        pass
 
-    with open(filename, "w") as f:
-        for l in lines:
-            f.write(l.rstrip("\r\n"))
-            f.write("\n")
+
+def _read_sysfs(filename):
+    """Return the stripped content of a sysfs file, or None."""
+    try:
+        with open(filename, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _pci_address(segment, bus, devfn):
+    """Format a PCI address the way sysfs does."""
+    return "{:04x}:{:02x}:{:02x}.{:x}".format(segment, bus, devfn >> 3, devfn & 0x07)
+
+
+def read_smbios_structures(smbios_type, root=SYSFS_ROOT):
+    """Return the formatted area of all SMBIOS structures of a type."""
+    structures = []
+    entries = path.join(root, "firmware/dmi/entries")
+    try:
+        names = os.listdir(entries)
+    except OSError:
+        return structures
+    prefix = "{}-".format(smbios_type)
+    for name in sorted(names, key=lambda n: int(n.split("-")[-1])):
+        if not name.startswith(prefix):
+            continue
+        try:
+            with open(path.join(entries, name, "raw"), "rb") as f:
+                raw = f.read()
+        except OSError:
+            continue
+        if len(raw) > 1 and raw[0] == smbios_type:
+            structures.append(raw[:raw[1]])
+    return structures
+
+
+def _smbios_onboard_devices(root):
+    """Map PCI address to instance of SMBIOS type 41 onboard devices."""
+    devices = dict()
+    for raw in read_smbios_structures(41, root):
+        if len(raw) < 0x0B:
+            continue
+        segment = int.from_bytes(raw[0x07:0x09], "little")
+        devices[_pci_address(segment, raw[0x09], raw[0x0A])] = raw[0x06]
+    return devices
+
+
+def _smbios_slots(root):
+    """Map PCI address to slot id of SMBIOS type 9 system slots."""
+    slots = dict()
+    for raw in read_smbios_structures(9, root):
+        if len(raw) < 0x11 or raw[0x0F] == 0xFF:
+            # Pre 2.6 entry or empty slot without a bus address
+            continue
+        segment = int.from_bytes(raw[0x0D:0x0F], "little")
+        slot_id = int.from_bytes(raw[0x09:0x0B], "little")
+        slots[_pci_address(segment, raw[0x0F], raw[0x10])] = slot_id
+    return slots
+
+
+def _network_ports(device):
+    """Return the interfaces of a PCI device in biosdevname port order."""
+    # Ports are ordered by dev_port, drivers older than it only set dev_id
+    net = path.join(device, "net")
+    ports = []
+    for ifname in os.listdir(net):
+        dev_port = _read_sysfs(path.join(net, ifname, "dev_port")) or "0"
+        dev_id = _read_sysfs(path.join(net, ifname, "dev_id")) or "0x0"
+        ports.append((int(dev_port), int(dev_id, 16), ifname))
+    ports.sort()
+    return [ifname for _, _, ifname in ports]
+
+
+def build_biosdevname_map(root=SYSFS_ROOT):
+    """Map PCI address of every network device to all_ethN style port names."""
+    # Ordering follows biosdevname --policy all_ethN: onboard devices by
+    # SMBIOS instance, then devices in slots by slot id, then the rest and
+    # finally SR-IOV virtual functions, each group in PCI address order.
+    # Every port of a multi port function gets its own name, in port order
+    pci_devices = path.join(root, "bus/pci/devices")
+    onboard = _smbios_onboard_devices(root)
+    slots = _smbios_slots(root)
+
+    order = []
+    for address in sorted(os.listdir(pci_devices)):
+        device = path.join(pci_devices, address)
+        pci_class = _read_sysfs(path.join(device, "class")) or ""
+        if not pci_class.startswith("0x02"):
+            # Not a network controller
+            continue
+
+        try:
+            ports = len(os.listdir(path.join(device, "net")))
+        except OSError:
+            ports = 0
+        # A device whose driver has not registered its interface yet still
+        # takes a name, so the devices after it keep theirs
+        ports = max(ports, 1)
+
+        if address in onboard:
+            order.append(((0, onboard[address]), address, ports))
+            continue
+        if path.exists(path.join(device, "physfn")):
+            order.append(((3, 0), address, ports))
+            continue
+        # The device itself or one of its parent bridges can be the slot
+        for parent in reversed(path.realpath(device).split("/")):
+            if parent in slots:
+                order.append(((1, slots[parent]), address, ports))
+                break
+        else:
+            order.append(((2, 0), address, ports))
+
+    order.sort()
+    names = dict()
+    index = 0
+    for _, address, ports in order:
+        names[address] = ["eth{}".format(i) for i in range(index, index + ports)]
+        index += ports
+    return names
+
+
+def _read_biosdevname_map(root):
+    """Return the biosdevname map, cached for the rest of the boot."""
+    # The cache is valid as long as the set of PCI devices is unchanged
+    key = (CACHE_VERSION, root, sorted(os.listdir(path.join(root, "bus/pci/devices"))))
+    try:
+        with open(BIOSDEVNAME_CACHE_FILE, "rb") as f:
+            cached_key, names = marshal.loads(f.read())
+        if cached_key == key:
+            return names
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    names = build_biosdevname_map(root)
+    try:
+        tmp_filename = "{}.{}".format(BIOSDEVNAME_CACHE_FILE, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            marshal.dump((key, names), f)
+        os.replace(tmp_filename, BIOSDEVNAME_CACHE_FILE)
+    except OSError:
+        pass
+    return names
+
+
+# Names from _read_biosdevname_map, kept for long lived processes
+_biosdevname_names = dict()
+
+
+def resolve_biosdevname(ifname, root=SYSFS_ROOT):
+    """Find the all_ethN name of an interface from sysfs and SMBIOS data."""
+    # Returns None when the interface can not be resolved here, the caller
+    # should then ask the biosdevname binary
+    device = path.realpath(path.join(root, "class/net", ifname, "device"))
+    address = path.basename(device)
+    if not path.isfile(path.join(root, "bus/pci/devices", address, "class")):
+        # Not a PCI device
+        return None
+    try:
+        ports = _network_ports(device)
+        port = ports.index(ifname)
+    except (OSError, ValueError):
+        return None
+
+    global _biosdevname_names
+    if len(_biosdevname_names.get(address, ())) != len(ports):
+        # First lookup, a hotplugged device or a port that was not
+        # registered when the map was built, reload the map
+        try:
+            _biosdevname_names = _read_biosdevname_map(root)
+            if len(_biosdevname_names.get(address, ())) != len(ports):
+                # Ports registered after the cache was written, its key
+                # only covers the set of PCI devices
+                _biosdevname_names = build_biosdevname_map(root)
+        except OSError:
+            return None
+    names = _biosdevname_names.get(address, ())
+    if len(names) != len(ports):
+        return None
+    return names[port]
+
+
+class NamingPolicy:
+    """Choose the name prefix of new interfaces from naming rules."""
+
+    # Rule keys in the order they are tried, most specific first. This order
+    # decides between matching rules, not the order of the rules file.
+    KEYS = ("pci", "parent", "driver", "oui")
+
+    def __init__(self, rules=()):
+        """Compile a list of (prefix, key, value) rules into a lookup table."""
+        # The first rule for a key and value wins
+        self.table = {key: dict() for key in self.KEYS}
+        for prefix, key, value in rules:
+            self.table[key].setdefault(value, prefix)
+
+    def __len__(self):
+        """Number of rules in the table."""
+        return sum(len(values) for values in self.table.values())
+
+    def prefix(self, facts):
+        """Return the prefix for an interface described by interface_facts()."""
+        for key in self.KEYS:
+            value = facts.get(key)
+            if value is None:
+                continue
+            prefix = self.table[key].get(value)
+            if prefix is None and key == "parent":
+                # parent=* matches every SR-IOV virtual function
+                prefix = self.table[key].get("*")
+            if prefix:
+                return prefix
+        return "eth"
+
+
+def read_naming_rules(filename):
+    """Read naming rules file."""
+    # Every line is "<prefix> = <key>=<value>", for example
+    #   mgmt = pci=0000:00:1f.6
+    #   vf = parent=*
+    #   lan = driver=ixgbe
+    #   oob = oui=00:1b:21
+    # Rules are not tried in file order. An interface gets the prefix of the
+    # matching rule with the most specific key: pci, then parent (a PF
+    # address before parent=*), then driver, then oui. When a key and value
+    # are listed more than once the first line wins.
+    rules = []
+    errors = []
+    with open(filename, "r", errors="replace") as f:
+        for index, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith(";"):
+                continue
+            prefix, _, condition = line.partition("=")
+            key, _, value = condition.partition("=")
+            prefix, key, value = prefix.strip(), key.strip(), value.strip()
+            if not _re.prefix.match(prefix):
+                errors.append("{}: Prefix must be 1 to 10 letters a-z, ignoring".format(index))
+            elif key not in NamingPolicy.KEYS or not value:
+                errors.append("{}: Rule must be <key>=<value> with key one of {}, ignoring".format(
+                    index, ", ".join(NamingPolicy.KEYS)))
+            else:
+                if key == "oui":
+                    value = value.lower().replace("-", ":")
+                rules.append((prefix, key, value))
+
+    if errors:
+        # Split in records /dev/kmsg accepts
+        for message in join_messages("{}: ".format(filename), errors):
+            log_to_dmesg(message, KmsgLogger.WARNING, key=filename)
+    return NamingPolicy(rules)
+
+
+def interface_facts(if_name, if_mac):
+    """Return the properties of an interface naming rules can match."""
+    facts = {"oui": normalize_mac(if_mac)[:8]}
+    device = path.join(SYSFS_NET, if_name, "device")
+    if path.exists(device):
+        facts["pci"] = path.basename(path.realpath(device))
+        driver = path.join(device, "driver")
+        if path.exists(driver):
+            facts["driver"] = path.basename(path.realpath(driver))
+        physfn = path.join(device, "physfn")
+        if path.exists(physfn):
+            facts["parent"] = path.basename(path.realpath(physfn))
+    return facts
+
+
+def naming_prefix(if_name, if_mac):
+    """Return the name prefix for a new interface."""
+    if not path.isfile(RULES_FILE):
+        return "eth"
+    try:
+        policy = read_cached(read_naming_rules, RULES_FILE)
+    except Exception:
+        log_to_dmesg(
+            "Exception reading naming rules: \n{}".format(format_exc()), KmsgLogger.ERR)
+        return "eth"
+    if not policy:
+        return "eth"
+    return policy.prefix(interface_facts(if_name, if_mac))
 
 
 def biosdevname(ifname):
@@ -208,26 +1246,37 @@ def biosdevname(ifname):
     # Dont use biosdevname when running on Xen
     # This rule is copied from the old perl script
     # dont know if it is really needed anymore
-    if path.isdir("/proc/xen"):
+    if path.isdir(ROOT + "/proc/xen"):
         log_to_dmesg(
-            "{}: biosdevname is not running on Xen guests".format(ifname))
+            "{}: biosdevname is not running on Xen guests".format(ifname),
+            key="biosdevname")
         return ""
     # biosdevname only runs on ethernet interfaces
     if not ifname.startswith("eth"):
         return ""
+    new_name = resolve_biosdevname(ifname)
+    if new_name:
+        log_to_dmesg(
+            "{}: resolved {} as interface name from sysfs".format(ifname, new_name),
+            key="biosdevname")
+        return new_name
     # Let the interface name changes ordered by previous invocations of this
     # script complete before we call biosdevname.  If we don't, biosdevame
     # may generate incorrect name.
-    sleep(1)
+    wait_for_pending_renames()
+    from subprocess import check_output, CalledProcessError
+
     try:
-        new_name = check_output(["/sbin/biosdevname", "--policy", "all_ethN", "-i", ifname]).strip()
+        new_name = check_output([BIOSDEVNAME, "--policy", "all_ethN", "-i", ifname]).decode().strip()
         log_to_dmesg(
-            "{}: biosdevname returned {} as interface name".format(ifname, new_name))
+            "{}: biosdevname returned {} as interface name".format(ifname, new_name),
+            key="biosdevname")
         return new_name
     except CalledProcessError:
         # biosdevname exited with an errorcode, will not use output
         log_to_dmesg(
-            "{}: biosdevname returned an error when trying to resolve interface name".format(ifname))
+            "{}: biosdevname returned an error when trying to resolve interface name".format(ifname),
+            KmsgLogger.WARNING, key="biosdevname")
     return ""
 
 
@@ -237,39 +1286,53 @@ def find_interface_in_old_config(if_mac):
     # Else return an empty string
     try:
 
-        if path.isfile("/config/config.boot"):
-            old_names = read_hwids_from_configfile("/config/config.boot")
-            for name, mac in old_names.items():
-                if mac == if_mac:
-                    return name
+        if path.isfile(CONFIG_BOOT_FILE):
+            old_names = read_cached(read_hwids_index_from_configfile, CONFIG_BOOT_FILE)
+            return old_names.name(if_mac) or ""
         else:
             log_to_dmesg(
                 "Configuration read from persistant interface name file, skipping boot configuration")
 
     except Exception:
         log_to_dmesg(
-            "Exception reading boot configuration file: \n{}".format(traceback.format_exc()))
+            "Exception reading boot configuration file: \n{}".format(format_exc()), KmsgLogger.ERR)
 
     return ""
 
 
-def main(if_name, if_mac):
+def main(if_name, if_mac, timer=_no_timer):
     """Script start."""
     # 2:  Look for config file /config/persistant-interface-names.conf?
     #     if found read it if not read config.boot for hw-id stamps
-    hwids = {}
+    hwids = HwidIndex()
     # 2a: Try to read persistant interface names from file
-    if path.isfile("/config/interface-names.persist"):
+    if path.isfile(PERSIST_FILE):
         try:
-            hwids = read_persistant_names_file("/config/interface-names.persist")
+            hwids = read_cached(read_persistant_names_index, PERSIST_FILE)
         except Exception:
             log_to_dmesg(
-                "Exception reading persistant interface name file: \n{}".format(traceback.format_exc()))
+                "Exception reading persistant interface name file: \n{}".format(format_exc()), KmsgLogger.ERR)
 
     # 3:  if interface is found return without futher processing
-    for new_name, mac in hwids.items():
-        if mac == if_mac:
-            return new_name
+    new_name = hwids.name(if_mac)
+    timer.mark("persist")
+    if new_name:
+        return new_name
+
+    # 3b: Use the name planned for the interface by a batch run
+    if path.isfile(PLAN_FILE):
+        try:
+            plan = read_cached(read_names_index, PLAN_FILE)
+            new_name = plan.name(if_mac)
+            timer.mark("plan")
+            if new_name:
+                return new_name
+            # Names in the plan are taken by other interfaces
+            hwids = hwids.copy()
+            hwids.update(plan.by_name)
+        except Exception:
+            log_to_dmesg(
+                "Exception reading interface name plan: \n{}".format(format_exc()), KmsgLogger.ERR)
 
     # No interface found with this mac address in persistent storage file
 
@@ -280,81 +1343,235 @@ def main(if_name, if_mac):
     # Load new_assigned_interfaces temp-file to the hwids database
     # THIS NEEDS TO BE DONE! :) but is only relevant on bootup, because
     # after boot is finished we can save directly to the persistance-file
-    if path.isfile("/run/udev/interface-names.tmp"):
+    if path.isfile(TMP_PERSIST_FILE):
         try:
-            new_assigned = read_persistant_names_file("/run/udev/interface-names.tmp")
+            new_assigned = read_cached(read_persistant_names_file, TMP_PERSIST_FILE)
+            # The cached index is shared between calls, update a copy
+            hwids = hwids.copy()
             hwids.update(new_assigned)
         except Exception:
             log_to_dmesg(
-                "cant read temp-persistant-file Exception: {}".format(traceback.format_exc()))
+                "cant read temp-persistant-file Exception: {}".format(format_exc()), KmsgLogger.ERR)
+    timer.mark("persist")
 
     # 2b:  MIGRATE FROM OLD CONFIG
     #      read persistant interface names from config.boot and se if we find this interface
     # HMM... need to check this,.. will it work? :S
     new_name = find_interface_in_old_config(if_mac)
+    timer.mark("migrate")
     if new_name:
         if new_name in hwids:
             log_to_dmesg(
-                "Error while saving old hw-id value to persistant storage, interface allready exists ")
+                "Error while saving old hw-id value to persistant storage, interface allready exists ",
+                KmsgLogger.ERR)
             return None
 
         # Save interface to database
         if not vyos_config_loaded():
             # We are not on a fully booted system, saving as a interface hint
-            save_persistant_names_file("/run/udev/interface-names.tmp", new_name, if_mac)
+            save_persistant_names_file(TMP_PERSIST_FILE, new_name, if_mac)
         else:
             # We are on a fully booted system
-            save_persistant_names_file("/config/interface-names.persist", new_name, if_mac)
+            save_persistant_names_file(PERSIST_FILE, new_name, if_mac)
+        timer.mark("migrate")
 
         return new_name
 
     # REGISTER NEW UNKNOWN INTERFACE
+    #   the naming rules select the prefix, eth unless a rule matches
     #   if a eth index is returned, use this as a "seed" to interface name mapper
-    #   else return eth0 as "seed"
-    new_name = biosdevname(if_name)
+    #   else return <prefix>0 as "seed"
+    prefix = naming_prefix(if_name, if_mac)
+    timer.mark("policy")
+    new_name = ""
+    if prefix == "eth":
+        # biosdevname only knows the eth namespace
+        new_name = biosdevname(if_name)
     if not new_name:
-        # No name returned from biosdevname, setting eth0 as seed
-        new_name = "eth0"
+        # No name returned from biosdevname, setting <prefix>0 as seed
+        new_name = prefix + "0"
+    timer.mark("biosdevname")
 
     if new_name in hwids:
         # Biosdevname index is in use, wee need to find a new one
         # Fetch index from new name as a seed, or use 0 as seed
         try:
-            seed = int(re.search(r'\d+$', new_name)[0])
+            seed = int(_re.trailing_digits.search(new_name)[0])
         except Exception:
             log_to_dmesg(
-                "Exception fetching index from biosdevname, proceeding with seed = eth0, {}".format(traceback.format_exc()))
+                "Exception fetching index from biosdevname, proceeding with seed = eth0, {}".format(format_exc()), KmsgLogger.ERR)
             seed = 0
 
-        # Check name availabillity or increment the if_name until we get a match
-        for x in range(seed, 10000):
-            temp_name = "eth{}".format(x)
-            if temp_name not in hwids:
-                # The interface is not in persistant database
-                # set as new name and break out of loop
-                new_name = temp_name
-                break
-        else:
+        # Find the first name not in the persistant database from seed and up
+        index = hwids.allocator(prefix).find(seed)
+        if index is None:
             log_to_dmesg(
-                "no available ifname's.. :S skipping ")
+                "no available ifname's.. :S skipping ", KmsgLogger.ERR)
             return None
+        new_name = "{}{}".format(prefix, index)
+    timer.mark("search")
 
     # We now have a new index that is available to allocation
 
-    log_to_dmesg("New name for {} is {}".format(if_name, new_name))
+    log_to_dmesg("New name for {} is {}".format(if_name, new_name), key="new-name")
+
+    # 6: Save the new name so the next interface does not get it as well
+    if not vyos_config_loaded():
+        # We are not on a fully booted system, saving as a interface hint
+        save_persistant_names_file(TMP_PERSIST_FILE, new_name, if_mac)
+    else:
+        # We are on a fully booted system
+        save_persistant_names_file(PERSIST_FILE, new_name, if_mac)
+    timer.mark("save")
 
     return new_name
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        # Step 1: Lock so only one instance at a time, this automatically unlocks on with end
-        with Locker("/run/udev/ifname.lock") as lock:
-            # Fetch new name
-            name = main(sys.argv[0], sys.argv[1])
-            if name:
-                print(name)
+def present_interfaces():
+    """Return (kernel name, mac) of all ethernet devices in sysfs."""
+    interfaces = []
+    for if_name in sorted(os.listdir(SYSFS_NET)):
+        if not path.exists(path.join(SYSFS_NET, if_name, "device")):
+            # Virtual interface
+            continue
+        if _read_sysfs(path.join(SYSFS_NET, if_name, "type")) != "1":
+            # Not ARPHRD_ETHER
+            continue
+        mac = _read_sysfs(path.join(SYSFS_NET, if_name, "address"))
+        if mac:
+            interfaces.append((if_name, mac))
+    return interfaces
+
+
+def plan_names(interfaces):
+    """Compute names for a list of (kernel name, mac) in one pass."""
+    # Returns a dict of kernel name to new name, and a list of (name, mac)
+    # migrated from config.boot or newly assigned that should be saved
+    hwids = HwidIndex()
+    for filename, reader in ((PERSIST_FILE, read_persistant_names_index),
+                             (TMP_PERSIST_FILE, read_names_index)):
+        if path.isfile(filename):
+            try:
+                hwids.update(reader(filename).by_name)
+            except Exception:
+                log_to_dmesg(
+                    "Exception reading {}: \n{}".format(filename, format_exc()), KmsgLogger.ERR)
+
+    plan = dict()
+    new_entries = []
+    taken = set(hwids.by_name)
+
+    # Interfaces found in the persistant names file
+    new = []
+    for if_name, mac in interfaces:
+        name = hwids.name(mac)
+        if name:
+            plan[if_name] = name
+        else:
+            new.append((if_name, mac))
+
+    # Interfaces migrated from the old config
+    old_names = HwidIndex()
+    if new and path.isfile(CONFIG_BOOT_FILE):
+        try:
+            old_names = read_hwids_index_from_configfile(CONFIG_BOOT_FILE)
+        except Exception:
+            log_to_dmesg(
+                "Exception reading boot configuration file: \n{}".format(format_exc()), KmsgLogger.ERR)
+    unnamed = []
+    for if_name, mac in new:
+        name = old_names.name(mac)
+        if not name:
+            unnamed.append((if_name, mac))
+        elif name in taken:
+            log_to_dmesg(
+                "{}: hw-id name {} from boot configuration is already in use".format(if_name, name),
+                KmsgLogger.ERR)
+        else:
+            plan[if_name] = name
+            new_entries.append((name, mac))
+            taken.add(name)
+
+    # New interfaces, biosdevname names or the first free index after them
+    allocators = dict()
+    for if_name, mac in unnamed:
+        prefix = naming_prefix(if_name, mac)
+        if prefix not in allocators:
+            allocators[prefix] = IndexAllocator(prefix, taken)
+        name = (biosdevname(if_name) if prefix == "eth" else "") or prefix + "0"
+        if name in taken:
+            try:
+                seed = int(_re.trailing_digits.search(name)[0])
+            except Exception:
+                seed = 0
+            name = allocators[prefix].allocate(seed)
+            if name is None:
+                log_to_dmesg("{}: no available ifname's.. :S skipping".format(if_name),
+                             KmsgLogger.ERR)
+                continue
+        plan[if_name] = name
+        new_entries.append((name, mac))
+        taken.add(name)
+        for allocator in allocators.values():
+            allocator.add_name(name)
+
+    return plan, new_entries
+
+
+def name_all_interfaces():
+    """Name all present interfaces in one pass and save the plan for udev."""
+    with Locker(LOCK_FILE, timeout=LOCK_TIMEOUT, log_stats=True):
+        interfaces = present_interfaces()
+        plan, new_entries = plan_names(interfaces)
+
+        # Planned names are returned to udev from the plan without reaching
+        # step 6 of main, so every new name is saved here in one write
+        if new_entries:
+            if not vyos_config_loaded():
+                save_persistant_names(TMP_PERSIST_FILE, new_entries)
             else:
-                log_to_dmesg("No new name selected.. :/ ")
+                save_persistant_names(PERSIST_FILE, new_entries)
+
+        # Written to a temp file and renamed, udev never sees a partial plan
+        tmp_filename = "{}.{}".format(PLAN_FILE, os.getpid())
+        with open(tmp_filename, "w") as f:
+            for if_name, mac in interfaces:
+                if if_name in plan:
+                    f.write("{} = {}\n".format(plan[if_name], mac))
+        os.replace(tmp_filename, PLAN_FILE)
+
+    return plan
+
+
+def name_interface(if_name, if_mac):
+    """Resolve the name of an interface while holding the naming lock."""
+    timer = PhaseTimer()
+    # Step 1: Lock so only one instance at a time, this automatically unlocks on with end
+    try:
+        with Locker(LOCK_FILE, timeout=LOCK_TIMEOUT, log_stats=True):
+            timer.mark("lock")
+            name = main(if_name, if_mac, timer)
+            if name and name != if_name:
+                # udev renames the interface after we return
+                record_pending_rename(if_name, name)
+    except LockTimeout as e:
+        log_to_dmesg("{}: {}, leaving name unchanged".format(if_name, e), KmsgLogger.ERR)
+        timer.emit(if_name, None)
+        return None
+    if not name:
+        log_to_dmesg("No new name selected.. :/ ", KmsgLogger.WARNING)
+    timer.emit(if_name, name)
+    return name
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--batch"]:
+        for if_name, name in sorted(name_all_interfaces().items()):
+            print("{} {}".format(if_name, name))
+    elif len(sys.argv) == 3:
+        name = name_interface(sys.argv[1], sys.argv[2])
+        if name:
+            print(name)
     else:
-        sys.exit("Syntax: vyos_nic_name.py [initial-name] [mac-address]")
+        sys.exit("Syntax: vyos_nic_name.py [initial-name] [mac-address]\n"
+                 "        vyos_nic_name.py --batch")
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+"""Boot storm benchmark for the VyOS Ethernet nic naming system."""
+
+import argparse
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+HERE = path.dirname(path.abspath(__file__))
+# Kernel names of the simulated interfaces start here, so udev renames in
+# the fake sysfs never collide with the names handed out
+KERNEL_BASE = 5000
+# Modules the persist hit path should not need
+HEAVY_MODULES = ("vyos.configtree", "subprocess", "traceback", "threading", "re")
+
+"""Benchmark workflow
+1: build a fake root in a temp directory: /config with a persist file and a
+   config.boot, /run/udev, /sys/class/net with one directory per interface,
+   a /sbin/biosdevname stub and a vyos.configtree stub on PYTHONPATH
+
+2: start one naming request per interface, at most --workers at a time like
+   udevd does, either running vyos_nic_name.py for each interface or asking
+   a running vyos_nic_named.py through vyos_nic_name_client.py
+
+3: rename the interface in the fake sysfs when a name is returned, the way
+   udev does
+
+4: report total boot naming time and p50/p99 time-to-name, and the average
+   of the per phase timings logged with VYOS_NIC_NAME_TIMING=1
+
+With --rename-wait only new interfaces are named, so every event waits for
+the renames handed to udev before it, while udev renames each interface
+--rename-delay ms after its name is returned. The time-to-name is reported
+for the wait in vyos_nic_name.py and for the sleep(1) it replaced.
+
+With --startup the cold start of vyos_nic_name.py for a MAC found in the
+persist file is timed instead, together with the modules it imported.
+
+With --journal a writer appending batches to a persist file, compacting it
+every few batches, is killed at random points over and over. After each kill
+the file must read without problems, and every entry of a save that finished
+before the kill must still be there.
+
+With --parse a persist file of --lines lines, a few of them illegal, is read
+by read_persistant_names_file(), by the compiled cache and by the parser it
+replaced, which opened /dev/kmsg for every illegal line.
+
+With --allocator IndexAllocator is compared with the linear probe from the
+seed up to the ceiling it replaced, on random used names and seeds.
+"""
+
+STUB_CONFIGTREE = '''
+import re
+
+
+class ConfigTree:
+    """Benchmark stub, only knows interfaces ethernet * hw-id."""
+
+    def __init__(self, config):
+        self._hwids = dict(re.findall(
+            r"ethernet (\\S+) \\{\\s*hw-id (\\S+)", config))
+
+    def list_nodes(self, path):
+        return list(self._hwids)
+
+    def exists(self, path):
+        return path[2] in self._hwids
+
+    def return_value(self, path):
+        return self._hwids[path[2]]
+'''
+
+# vyos_nic_name.py with the fixed sleep(1) before biosdevname it used to have
+SLEEP_NAMER = """
+import sys
+import time
+import vyos_nic_name
+
+vyos_nic_name.wait_for_pending_renames = lambda: time.sleep(1)
+name = vyos_nic_name.name_interface(sys.argv[1], sys.argv[2])
+if name:
+    print(name)
+"""
+
+STUB_BIOSDEVNAME = """#!/bin/sh
+# Benchmark stub, biosdevname never finds a name
+exit 1
+"""
+
+
+def mac_address(i):
+    """Return a locally administered MAC for interface number i."""
+    return "02:00:00:{:02x}:{:02x}:{:02x}".format(i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF)
+
+
+def write(filename, data, mode=0o644):
+    """Write a file, creating parent directories."""
+    os.makedirs(path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        f.write(data)
+    os.chmod(filename, mode)
+
+
+def build_root(root, count, known, migrate):
+    """Create a fake root with count interfaces, return (kernel name, mac)."""
+    # The first known part of the interfaces is in the persist file, the
+    # next migrate part only in config.boot and the rest is new
+    known = int(count * known)
+    migrate = int(count * migrate)
+
+    write(path.join(root, "stub/vyos/__init__.py"), "")
+    write(path.join(root, "stub/vyos/configtree.py"), STUB_CONFIGTREE)
+    write(path.join(root, "sbin/biosdevname"), STUB_BIOSDEVNAME, 0o755)
+    os.makedirs(path.join(root, "run/udev"))
+
+    interfaces = []
+    persist = []
+    config = []
+    for i in range(count):
+        if_name = "eth{}".format(KERNEL_BASE + i)
+        mac = mac_address(i)
+        interfaces.append((if_name, mac))
+        if i < known:
+            persist.append("eth{} = {}\n".format(i, mac))
+        elif i < known + migrate:
+            config.append("    ethernet eth{} {{\n        hw-id {}\n    }}\n".format(i, mac))
+
+        device = path.join(root, "sys/class/net", if_name)
+        write(path.join(device, "ifindex"), "{}\n".format(i + 2))
+        write(path.join(device, "type"), "1\n")
+        write(path.join(device, "address"), mac + "\n")
+
+    write(path.join(root, "config/interface-names.persist"), "".join(persist))
+    write(path.join(root, "config/config.boot"),
+          "interfaces {{\n{}}}\nsystem {{\n    host-name vyos\n}}\n".format("".join(config)))
+    return interfaces
+
+
+def percentile(values, p):
+    """Return the p percentile of values, nearest rank."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def phase_averages(logfile):
+    """Average the timing lines in the log, in milliseconds."""
+    totals = dict()
+    events = 0
+    with open(logfile, "r", errors="replace") as f:
+        for line in f:
+            if "timing if=" not in line:
+                continue
+            events += 1
+            for field in line.split():
+                key, _, value = field.partition("=")
+                if key.endswith("_ms"):
+                    totals[key[:-3]] = totals.get(key[:-3], 0) + float(value)
+    return {phase: total / events for phase, total in totals.items()}
+
+
+def wait_for_socket(filename, timeout=10):
+    """Wait until the daemon accepts connections."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(filename)
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError("vyos_nic_named.py did not start")
+
+
+def run_storm(count, args, command=None):
+    """Name count interfaces in a fresh fake root, return the results."""
+    with tempfile.TemporaryDirectory(prefix="vyos_nic_bench-") as root:
+        interfaces = build_root(root, count, args.known, args.migrate)
+        logfile = path.join(root, "kmsg")
+        env = dict(os.environ,
+                   VYOS_NIC_NAME_ROOT=root,
+                   VYOS_NIC_NAME_LOG=logfile,
+                   VYOS_NIC_NAME_TIMING="1",
+                   PYTHONPATH=os.pathsep.join([path.join(root, "stub"), HERE]))
+
+        daemon = None
+        timers = []
+        if command is None and args.mode == "daemon":
+            sock = path.join(root, "run/udev/vyos_nic_name.sock")
+            daemon = subprocess.Popen(
+                [sys.executable, path.join(HERE, "vyos_nic_named.py"),
+                 "--socket", sock, "--idle-timeout", "0"], env=env)
+            wait_for_socket(sock)
+            command = [sys.executable, path.join(HERE, "vyos_nic_name_client.py")]
+        elif command is None:
+            command = [sys.executable, path.join(HERE, "vyos_nic_name.py")]
+
+        def name_one(interface):
+            if_name, mac = interface
+            start = time.monotonic()
+            result = subprocess.run(command + [if_name, mac], env=env,
+                                    stdout=subprocess.PIPE, timeout=300)
+            elapsed = time.monotonic() - start
+            name = result.stdout.decode().strip()
+            if name and name != if_name:
+                if args.rename_delay:
+                    timer = threading.Timer(args.rename_delay / 1000, rename, (if_name, name))
+                    timers.append(timer)
+                    timer.start()
+                else:
+                    rename(if_name, name)
+            return elapsed, name
+
+        def rename(if_name, name):
+            # Rename like udev, a taken name leaves the kernel name
+            try:
+                os.rename(path.join(root, "sys/class/net", if_name),
+                          path.join(root, "sys/class/net", name))
+            except OSError:
+                pass
+
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                results = list(pool.map(name_one, interfaces))
+        finally:
+            if daemon:
+                daemon.terminate()
+                daemon.wait()
+        total = time.monotonic() - start
+        for timer in timers:
+            timer.join()
+
+        phases = phase_averages(logfile) if path.exists(logfile) else {}
+
+    latencies = [r[0] for r in results]
+    names = [r[1] for r in results if r[1]]
+    return {
+        "total": total,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "named": len(names),
+        "duplicates": len(names) - len(set(names)),
+        "phases": phases,
+    }
+
+
+def run_rename_wait(args):
+    """Time naming new interfaces with the rename wait and with sleep(1)."""
+    delay = 20 if args.rename_delay is None else args.rename_delay
+    args = argparse.Namespace(**dict(vars(args), known=0.0, migrate=0.0, rename_delay=delay))
+    print("{:<26} {:>9} {:>9} {:>9} {:>6}".format("N={}".format(args.rename_count),
+                                                  "total_s", "p50_ms", "p99_ms", "named"))
+    for label, command in (("wait for pending renames", [sys.executable, path.join(HERE, "vyos_nic_name.py")]),
+                           ("sleep(1)", [sys.executable, "-c", SLEEP_NAMER])):
+        r = run_storm(args.rename_count, args, command)
+        print("{:<26} {:>9.3f} {:>9.1f} {:>9.1f} {:>6}".format(
+            label, r["total"], r["p50"] * 1000, r["p99"] * 1000, r["named"]))
+        sys.stdout.flush()
+
+
+def run_startup(args):
+    """Time cold starts of vyos_nic_name.py for a MAC in the persist file."""
+    with tempfile.TemporaryDirectory(prefix="vyos_nic_bench-") as root:
+        if_name, mac = build_root(root, 1, 1.0, 0)[0]
+        env = dict(os.environ,
+                   VYOS_NIC_NAME_ROOT=root,
+                   VYOS_NIC_NAME_LOG=path.join(root, "kmsg"),
+                   PYTHONPATH=os.pathsep.join([path.join(root, "stub"), HERE]))
+        script = [path.join(HERE, "vyos_nic_name.py"), if_name, mac]
+
+        # The first run writes the compiled persist file cache
+        subprocess.run([sys.executable] + script, env=env, stdout=subprocess.DEVNULL, check=True)
+
+        def timed(command):
+            times = []
+            modules = set()
+            for _ in range(args.repeat):
+                start = time.monotonic()
+                result = subprocess.run(command, env=env, check=True,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                times.append(time.monotonic() - start)
+                for line in result.stderr.decode().splitlines():
+                    if line.startswith("import time:"):
+                        modules.add(line.rsplit("|", 1)[-1].strip())
+            return times, modules
+
+        floor, _ = timed([sys.executable, "-c", "pass"])
+        times, modules = timed([sys.executable, "-X", "importtime"] + script)
+
+    print("interpreter  p50 {:.1f} ms".format(percentile(floor, 50) * 1000))
+    print("persist hit  p50 {:.1f} ms  p99 {:.1f} ms".format(
+        percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+    print("heavy modules imported: {}".format(
+        ", ".join(m for m in HEAVY_MODULES if m in modules) or "none"))
+
+
+def journal_mac(batch, i):
+    """Return the MAC saved for interface eth<i> by journal batch number batch."""
+    return "02:00:{:02x}:{:02x}:{:02x}:{:02x}".format(batch >> 16 & 0xFF, batch >> 8 & 0xFF,
+                                                      batch & 0xFF, i)
+
+
+def journal_state(interfaces, batch_size):
+    """Return the batch number each interface was last saved by, -1 if never."""
+    if not set(interfaces) <= set("eth{}".format(i) for i in range(batch_size)):
+        raise ValueError("unexpected interfaces: {}".format(sorted(interfaces)))
+    state = []
+    for i in range(batch_size):
+        mac = interfaces.get("eth{}".format(i))
+        if mac is None:
+            state.append(-1)
+            continue
+        octets = mac.split(":")
+        batch = int(octets[2] + octets[3] + octets[4], 16) if len(octets) == 6 else -1
+        if mac != journal_mac(batch, i):
+            raise ValueError("eth{} = {} was not saved".format(i, mac))
+        state.append(batch)
+    return state
+
+
+def journal_writer(filename, batch_size):
+    """Save batches of entries to filename until killed."""
+    import vyos_nic_name
+
+    # Compact every few batches so kills also land in the middle of a compaction
+    vyos_nic_name.JOURNAL_COMPACT_SIZE = 4096
+    while True:
+        state = journal_state(vyos_nic_name.read_persistant_names_file(filename), batch_size)
+        batch = max(state) + 1
+        vyos_nic_name.save_persistant_names(
+            filename, [("eth{}".format(i), journal_mac(batch, i)) for i in range(batch_size)])
+
+
+def run_journal(args):
+    """Kill a persist file writer at random points and check the file after each kill."""
+    import vyos_nic_name
+
+    records = []
+    vyos_nic_name.logger = vyos_nic_name.KmsgLogger(sink=records)
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="vyos_nic_bench-") as root:
+        filename = path.join(root, "interface-names.persist")
+        env = dict(os.environ,
+                   VYOS_NIC_NAME_LOG=path.join(root, "kmsg"),
+                   PYTHONPATH=HERE)
+        writer_code = "import vyos_nic_name_bench; vyos_nic_name_bench.journal_writer({!r}, {})".format(
+            filename, args.batch_size)
+        open(filename, "w").close()
+        saved = [-1] * args.batch_size
+        for kill in range(args.kills):
+            writer = subprocess.Popen([sys.executable, "-c", writer_code], env=env)
+            time.sleep(random.uniform(0, args.kill_delay))
+            writer.send_signal(signal.SIGKILL)
+            writer.wait()
+
+            # Every entry of a batch can be lost when the writer was killed
+            # during its save, entries of earlier saves never
+            del records[:]
+            try:
+                state = journal_state(vyos_nic_name.read_persistant_names_file(filename),
+                                      args.batch_size)
+                if records:
+                    raise ValueError(records[0])
+                lost = [i for i in range(args.batch_size) if state[i] < saved[i]]
+                if lost:
+                    raise ValueError("lost eth{} batch {}, found batch {}".format(
+                        lost[0], saved[lost[0]], state[lost[0]]))
+                if state != sorted(state, reverse=True):
+                    raise ValueError("entries saved out of order: {}".format(state))
+            except ValueError as e:
+                failures += 1
+                print("kill {}: {}".format(kill, e))
+                # Start over from an empty file
+                open(filename, "w").close()
+                saved = [-1] * args.batch_size
+                continue
+            saved = state
+
+    print("{} kills, {} batches saved, {} failures".format(args.kills, max(saved) + 1, failures))
+    return failures
+
+
+def baseline_read_persistant_names(filename, logfile):
+    """Read a persist file the way vyos_nic_name.py did before the streaming parser."""
+    import re
+
+    def log_to_dmesg(message):
+        with open(logfile, "a") as f:
+            f.write("vyos_nic_name: {}".format(message))
+
+    interfaces = dict()
+    with open(filename, "r", errors="replace") as f:
+        for _l in enumerate(f.readlines()):
+            index = _l[0] + 1
+            line = _l[1].strip()
+            if not line:
+                continue
+            if line.startswith("#") or line.startswith(";"):
+                continue
+            entry = line.split("=", 2)
+            if len(entry) != 2:
+                log_to_dmesg("{}: Illegal entry found in config file, ignoring".format(index))
+                continue
+            intf = entry[0].strip()
+            mac = entry[1].strip()
+            if not intf:
+                log_to_dmesg("{}: Empty interfacename is found, ignoring".format(index))
+                continue
+            if len(intf) > 16:
+                log_to_dmesg(
+                    "{}: Interface name is to to long. Max length is 16 chars, ignoring".format(index))
+                continue
+            if not re.match(r'^[a-zA-Z0-9\-\.\_]+$', intf):
+                log_to_dmesg(
+                    "{}: Interface name contains illegal characters. Only a-z 0-9 - _ . is allowed, ignoring".format(index))
+                continue
+            if not mac:
+                log_to_dmesg("{}: MAC value can not be empty".format(index))
+            if not re.match(r'^[a-zA-Z0-9\-\.\_\:]+$', mac):
+                log_to_dmesg(
+                    "{}: Interface name contains illegal characters in MAC field. Only a-z 0-9 - _ . : is allowed, ignoring".format(index))
+                continue
+            interfaces[intf] = mac
+    return interfaces
+
+
+def run_parse(args):
+    """Time reading a persist file of args.lines lines."""
+    import vyos_nic_name
+
+    with tempfile.TemporaryDirectory(prefix="vyos_nic_bench-") as root:
+        filename = path.join(root, "interface-names.persist")
+        logfile = path.join(root, "kmsg")
+        with open(filename, "w") as f:
+            f.write("# Interface names\n")
+            for i in range(args.lines - 1):
+                if i % 1000 == 999:
+                    f.write("eth{} 02:00:00:00:00:00\n".format(i))
+                else:
+                    f.write("eth{} = {}\n".format(i, mac_address(i)))
+
+        def current():
+            # A new logger per run, a naming event reads the file once
+            vyos_nic_name.logger = vyos_nic_name.KmsgLogger(logfile)
+            return vyos_nic_name.read_persistant_names_file(filename)
+
+        def cached():
+            vyos_nic_name.logger = vyos_nic_name.KmsgLogger(logfile)
+            return vyos_nic_name.read_persistant_names_index(filename)
+
+        if current() != baseline_read_persistant_names(filename, logfile):
+            raise RuntimeError("read_persistant_names_file() differs from the old parser")
+
+        print("{} lines, {} illegal, best of {}".format(args.lines, args.lines // 1000, args.repeat))
+        for label, function in (("old parser", lambda: baseline_read_persistant_names(filename, logfile)),
+                                ("read_persistant_names_file", current),
+                                ("compiled cache", cached)):
+            times = []
+            for _ in range(args.repeat):
+                start = time.monotonic()
+                function()
+                times.append(time.monotonic() - start)
+            print("{:<28} {:>9.1f} ms".format(label, min(times) * 1000))
+            sys.stdout.flush()
+
+
+def linear_allocate(prefix, taken, seed, ceiling):
+    """Return the first free name from seed, probing like main() did before IndexAllocator."""
+    for x in range(seed, ceiling):
+        name = "{}{}".format(prefix, x)
+        if name not in taken:
+            return name
+    return None
+
+
+def run_allocator(args):
+    """Compare IndexAllocator with the linear probe on random names, return the failures."""
+    from vyos_nic_name import IndexAllocator
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    rng = random.Random(seed)
+    failures = 0
+    for trial in range(args.rounds):
+        prefix = rng.choice(["eth", "wlan", "e"])
+        ceiling = rng.choice([1, 10, 64, 10000])
+        # Mostly names with the prefix, dense or sparse, with some that only
+        # look like one: other prefixes, leading zeros and VLANs
+        density = rng.random()
+        taken = set("{}{}".format(prefix, i) for i in range(min(ceiling + 5, 300))
+                    if rng.random() < density)
+        taken.update(rng.choice(["{}0{}", "{}{}.5", "bond{1}", "eth{}", "{}-{}"]).format(
+            prefix, rng.randrange(ceiling + 5)) for _ in range(rng.randrange(5)))
+        allocator = IndexAllocator(prefix, taken, ceiling)
+        original = allocator.copy()
+        before = set(taken)
+
+        for step in range(rng.randrange(1, 50)):
+            if rng.random() < 0.2:
+                name = "{}{}".format(prefix, rng.randrange(ceiling + 5))
+                allocator.add_name(name)
+                taken.add(name)
+            start = rng.randrange(ceiling + 5)
+            expected = linear_allocate(prefix, taken, start, ceiling)
+            name = allocator.allocate(start)
+            if name != expected:
+                failures += 1
+                print("round {}: allocate({}) returned {}, expected {} (prefix {}, ceiling {})".format(
+                    trial, start, name, expected, prefix, ceiling))
+                break
+            if name:
+                taken.add(name)
+
+        # Allocations never change a copy
+        for start in range(0, ceiling + 5, max(1, ceiling // 16)):
+            expected = linear_allocate(prefix, before, start, ceiling)
+            if original.allocate(start) != expected:
+                failures += 1
+                print("round {}: copy changed by allocations".format(trial))
+                break
+            if expected:
+                before.add(expected)
+
+    print("{} rounds, seed {}, {} failures".format(args.rounds, seed, failures))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a boot storm of udev naming events.")
+    parser.add_argument("--sizes", default="8,16,32,64,128,256,512,1024",
+                        help="comma separated number of interfaces per run")
+    parser.add_argument("--mode", choices=["script", "daemon"], default="script",
+                        help="run vyos_nic_name.py per event or ask vyos_nic_named.py")
+    parser.add_argument("--workers", type=int, default=8 + 2 * (os.cpu_count() or 1),
+                        help="concurrent naming requests, udev children-max by default")
+    parser.add_argument("--startup", action="store_true",
+                        help="time cold starts for a MAC found in the persist file")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of runs to take the best time of with --startup and --parse")
+    parser.add_argument("--rename-wait", action="store_true",
+                        help="time naming new interfaces with the rename wait and with sleep(1)")
+    parser.add_argument("--rename-count", type=int, default=16,
+                        help="number of new interfaces to name with --rename-wait")
+    parser.add_argument("--rename-delay", type=float,
+                        help="ms between returning a name and udev renaming the interface, "
+                             "20 with --rename-wait and 0 otherwise")
+    parser.add_argument("--parse", action="store_true",
+                        help="time reading a large persist file")
+    parser.add_argument("--lines", type=int, default=100000,
+                        help="lines in the persist file read with --parse")
+    parser.add_argument("--journal", action="store_true",
+                        help="kill a persist file writer at random points and check the file")
+    parser.add_argument("--kills", type=int, default=1000,
+                        help="number of writers to kill with --journal")
+    parser.add_argument("--kill-delay", type=float, default=0.2,
+                        help="longest time in seconds a writer runs with --journal")
+    parser.add_argument("--batch-size", type=int, default=200,
+                        help="entries saved in one write with --journal")
+    parser.add_argument("--allocator", action="store_true",
+                        help="compare IndexAllocator with the linear probe it replaced")
+    parser.add_argument("--rounds", type=int, default=10000,
+                        help="random name sets to compare with --allocator")
+    parser.add_argument("--seed", type=int,
+                        help="random seed for --allocator, printed when not given")
+    parser.add_argument("--known", type=float, default=0.5,
+                        help="part of the interfaces found in the persist file")
+    parser.add_argument("--migrate", type=float, default=0.1,
+                        help="part of the interfaces only found in config.boot")
+    args = parser.parse_args()
+
+    if args.startup:
+        run_startup(args)
+        sys.exit(0)
+    if args.rename_wait:
+        run_rename_wait(args)
+        sys.exit(0)
+    if args.parse:
+        run_parse(args)
+        sys.exit(0)
+    if args.journal:
+        sys.exit(1 if run_journal(args) else 0)
+    if args.allocator:
+        sys.exit(1 if run_allocator(args) else 0)
+
+    print("{:>6} {:>9} {:>9} {:>9} {:>6} {:>5}  {}".format(
+        "N", "total_s", "p50_ms", "p99_ms", "named", "dup", "phase averages (ms)"))
+    for count in (int(n) for n in args.sizes.split(",")):
+        r = run_storm(count, args)
+        print("{:>6} {:>9.3f} {:>9.1f} {:>9.1f} {:>6} {:>5}  {}".format(
+            count, r["total"], r["p50"] * 1000, r["p99"] * 1000, r["named"], r["duplicates"],
+            " ".join("{}={:.2f}".format(k, v) for k, v in sorted(r["phases"].items()))))
+        sys.stdout.flush()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Check of the in-process biosdevname names against a fake sysfs."""
+
+import os
+import struct
+import sys
+import tempfile
+from os import path
+
+import vyos_nic_name
+
+# Fake devices: PCI address, parent bridge, SMBIOS placement and the ports
+# as (kernel name, dev_port). The multi port NIC registered its second port
+# first, so kernel name order is not port order.
+DEVICES = (
+    ("0000:00:19.0", None, ("onboard", 1), (("eth0", 0),)),
+    ("0000:02:00.0", "0000:00:1c.0", ("slot", 1), (("eth2", 0), ("eth1", 1))),
+    ("0000:03:00.0", "0000:00:1c.4", None, (("eth3", 0),)),
+)
+
+"""Check workflow
+1: build a sysfs tree in a temp directory with the PCI devices of DEVICES
+   below /sys/devices, the /sys/bus/pci/devices and /sys/class/net links
+   to them and SMBIOS type 41 and type 9 entries in /sys/firmware/dmi
+
+2: build the map with build_biosdevname_map() and compare it with the names
+   biosdevname --policy all_ethN gives: the onboard NIC first, then both
+   ports of the NIC in slot 1, then the NIC in no slot, so the port count
+   of the multi port NIC moves the name of every NIC after it
+
+3: resolve every kernel name with resolve_biosdevname() and compare it with
+   the name of its port
+"""
+
+EXPECTED_MAP = {
+    "0000:00:19.0": ["eth0"],
+    "0000:02:00.0": ["eth1", "eth2"],
+    "0000:03:00.0": ["eth3"],
+}
+EXPECTED_NAMES = {"eth0": "eth0", "eth2": "eth1", "eth1": "eth2", "eth3": "eth3"}
+
+
+def write(filename, content):
+    """Write a file and the directories above it."""
+    os.makedirs(path.dirname(filename), exist_ok=True)
+    with open(filename, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+
+
+def pci_devfn(address):
+    """Return segment, bus and devfn of a sysfs PCI address."""
+    segment, bus, slot_function = address.split(":")
+    slot, function = slot_function.split(".")
+    return int(segment, 16), int(bus, 16), int(slot, 16) << 3 | int(function, 16)
+
+
+def smbios_onboard(instance, address):
+    """Return a SMBIOS type 41 onboard device structure."""
+    segment, bus, devfn = pci_devfn(address)
+    return struct.pack("<BBHBBBHBB", 41, 0x0B, 0, 1, 0x85, instance, segment, bus, devfn) + b"\0\0"
+
+
+def smbios_slot(slot_id, address):
+    """Return a SMBIOS type 9 system slot structure."""
+    segment, bus, devfn = pci_devfn(address)
+    return struct.pack("<BBHBBBBBHBBHBB", 9, 0x11, 0, 1, 0xA6, 0x0D, 0x04, 0x04, slot_id, 0x04, 0x02,
+                       segment, bus, devfn) + b"\0\0"
+
+
+def build_sysfs(root):
+    """Build the fake sysfs of DEVICES below root."""
+    for address, bridge, placement, ports in DEVICES:
+        parents = ["devices", "pci0000:00"] + ([bridge] if bridge else []) + [address]
+        device = path.join(root, *parents)
+        write(path.join(device, "class"), "0x020000\n")
+        os.makedirs(path.join(root, "bus/pci/devices"), exist_ok=True)
+        os.symlink(device, path.join(root, "bus/pci/devices", address))
+        for ifname, dev_port in ports:
+            net = path.join(device, "net", ifname)
+            write(path.join(net, "dev_port"), "{}\n".format(dev_port))
+            write(path.join(net, "dev_id"), "0x0\n")
+            os.symlink("../..", path.join(net, "device"))
+            os.makedirs(path.join(root, "class/net"), exist_ok=True)
+            os.symlink(net, path.join(root, "class/net", ifname))
+        if placement is None:
+            continue
+        kind, number = placement
+        if kind == "onboard":
+            raw = smbios_onboard(number, address)
+            name = "41-{}".format(number - 1)
+        else:
+            raw = smbios_slot(number, address)
+            name = "9-{}".format(number - 1)
+        write(path.join(root, "firmware/dmi/entries", name, "raw"), raw)
+
+
+def check():
+    """Return a list of differences with the names biosdevname gives."""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        root = path.join(tmp, "sys")
+        build_sysfs(root)
+        vyos_nic_name.BIOSDEVNAME_CACHE_FILE = path.join(tmp, "biosdevname.cache")
+
+        names = vyos_nic_name.build_biosdevname_map(root)
+        if names != EXPECTED_MAP:
+            problems.append("map {} != {}".format(names, EXPECTED_MAP))
+        for ifname, expected in sorted(EXPECTED_NAMES.items()):
+            name = vyos_nic_name.resolve_biosdevname(ifname, root)
+            if name != expected:
+                problems.append("{}: resolved {} != {}".format(ifname, name, expected))
+    return problems
+
+
+if __name__ == "__main__":
+    problems = check()
+    for problem in problems:
+        print(problem)
+    print("{} problems".format(len(problems)))
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""VyOS Ethernet nic naming client, called by udev."""
+
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get("VYOS_NIC_NAME_ROOT", "") + "/run/udev/vyos_nic_name.sock"
+# Seconds to wait for the daemon's answer. The daemon can wait LOCK_TIMEOUT
+# (60 seconds) for the naming lock and then name the requests queued before
+# this one, udev kills the event after 180 seconds
+QUERY_TIMEOUT = 150
+"""Udev workflow
+NB: stdout is used to return data to UDEV, same as vyos_nic_name.py
+
+1: send "<initial-name> <mac-address>" to the naming daemon
+2: print the returned name to stdout for processing by udevd
+3: if the daemon is not reachable, fall back to running vyos_nic_name.py
+   directly so interfaces are still named. A daemon that does not answer in
+   time is still naming, running the script next to it would race it, so
+   the name is left unchanged instead
+"""
+
+
+def query(if_name, if_mac, timeout=QUERY_TIMEOUT):
+    """Ask the naming daemon for the name of an interface."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(SOCKET_PATH)
+        s.sendall("{} {}\n".format(if_name, if_mac).encode())
+        s.shutdown(socket.SHUT_WR)
+        reply = b""
+        while True:
+            data = s.recv(256)
+            if not data:
+                break
+            reply += data
+    return reply.decode(errors="replace").strip()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Syntax: vyos_nic_name_client.py [initial-name] [mac-address]")
+
+    try:
+        name = query(sys.argv[1], sys.argv[2])
+    except socket.timeout:
+        sys.exit("{}: no answer from the naming daemon within {} seconds, leaving name unchanged".format(
+            sys.argv[1], QUERY_TIMEOUT))
+    except OSError:
+        # Daemon not running, let the naming script do the work in-process
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "vyos_nic_name.py")
+        os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+
+    if name:
+        print(name)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""VyOS Ethernet nic naming daemon."""
+
+import argparse
+import os
+import socket
+import sys
+import traceback
+
+import vyos_nic_name
+from vyos_nic_name_client import SOCKET_PATH
+
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+"""Daemon workflow
+Keeps vyos_nic_name.py loaded between udev events, so the interpreter start,
+module imports and parsing of the naming files is only paid once per boot.
+
+1: take the listening socket from systemd, or bind our own
+2: for each connection read "<initial-name> <mac-address>" and answer with
+   the name returned by vyos_nic_name.main(), an empty line means no name
+3: exit when no requests has arrived for --idle-timeout seconds, systemd will
+   start us again on the next connection
+"""
+
+
+def systemd_socket():
+    """Return the socket passed by systemd socket activation, if any."""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    if int(os.environ.get("LISTEN_FDS", "0")) < 1:
+        return None
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+def bind_socket(filename):
+    """Create a listening unix socket."""
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(filename)
+    os.chmod(filename, 0o600)
+    s.listen(64)
+    return s
+
+
+def handle(conn):
+    """Answer one naming request."""
+    conn.settimeout(5)
+    request = b""
+    while b"\n" not in request and len(request) < 256:
+        data = conn.recv(256)
+        if not data:
+            break
+        request += data
+
+    name = None
+    entry = request.decode(errors="replace").split()
+    if len(entry) == 2:
+        try:
+            name = vyos_nic_name.name_interface(entry[0], entry[1])
+        except Exception:
+            vyos_nic_name.log_to_dmesg(
+                "Exception resolving interface name: \n{}".format(traceback.format_exc()),
+                vyos_nic_name.KmsgLogger.ERR)
+    else:
+        vyos_nic_name.log_to_dmesg(
+            "Illegal request received by naming daemon, ignoring",
+            vyos_nic_name.KmsgLogger.WARNING, key="daemon-request")
+
+    conn.sendall("{}\n".format(name or "").encode())
+
+
+def serve(sock, idle_timeout):
+    """Serve naming requests until idle for idle_timeout seconds."""
+    sock.settimeout(idle_timeout)
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except socket.timeout:
+            return
+        with conn:
+            try:
+                handle(conn)
+            except OSError:
+                # Client went away, nothing to answer
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VyOS nic naming daemon.")
+    parser.add_argument("--socket", default=SOCKET_PATH,
+                        help="unix socket to listen on when not socket activated")
+    parser.add_argument("--idle-timeout", type=float, default=60,
+                        help="exit after this many seconds without requests, 0 runs forever")
+    args = parser.parse_args()
+
+    sock = systemd_socket()
+    if sock is None:
+        sock = bind_socket(args.socket)
+
+    serve(sock, args.idle_timeout or None)
+    sys.exit(0)
@@ -1,56 +1,689 @@
 #!/usr/bin/env python3
+import os
+import socket
+import struct
 import subprocess
+from base64 import b64encode
 from datetime import datetime
+from errno import ENODEV
+from os import path
+from time import monotonic, time
 
+SYSFS_NET = "/sys/class/net"
 
-def wireguard_dump():
+# Generic netlink, see linux/netlink.h and linux/genetlink.h
+NETLINK_GENERIC = 16
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_DUMP = 0x300
+NLA_TYPE_MASK = 0x3FFF
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+RECV_SIZE = 1 << 16
+
+# WireGuard generic netlink family, see linux/wireguard.h
+WG_GENL_NAME = b"wireguard"
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PRIVATE_KEY = 3
+WGDEVICE_A_PUBLIC_KEY = 4
+WGDEVICE_A_LISTEN_PORT = 6
+WGDEVICE_A_FWMARK = 7
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL = 5
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+NLMSGHDR = struct.Struct("=IHHII")
+GENLMSGHDR = struct.Struct("=BBH")
+NLATTR = struct.Struct("=HH")
+U16 = struct.Struct("=H")
+U32 = struct.Struct("=I")
+U64 = struct.Struct("=Q")
+EMPTY_KEY = bytes(32)
+# Allowed IPs as the kernel writes them, family, address and cidr attributes
+# in that order, by the size of the nested attribute
+ALLOWEDIP_LAYOUTS = {
+    24: (socket.AF_INET, struct.Struct("=HHH2xHH4sHHB3x")),
+    36: (socket.AF_INET6, struct.Struct("=HHH2xHH16sHHB3x")),
+}
+
+"""Dump workflow
+1: list the wireguard devices in sysfs and resolve the wireguard generic
+   netlink family, if that fails fall back to `wg show all dump`
+
+2: send WG_CMD_GET_DEVICE as a dump request for each device, the kernel
+   splits large devices over several messages and may continue the last
+   peer of a message in the next one. Without CAP_NET_ADMIN the first
+   request fails with EPERM, then fall back to `wg show all dump` too
+
+3: yield one row for the device followed by one row per peer, the rows of
+   both backends look the same so wireguard_dump() does not care which one
+   was used
+
+Rows are yielded as they are read, so wireguard_rows() and wireguard_peers()
+can be consumed in constant memory, wireguard_dump() collects them in a dict.
+Rows are slotted Device and Peer records, as_dict() returns the dict form.
+"""
+
+
+class Device:
+    """A wireguard interface, a row of wireguard_rows()."""
+
+    __slots__ = ("name", "private_key", "public_key", "listen_port", "fw_mark")
+
+    def __init__(self, name, private_key, public_key, listen_port, fw_mark):
+        self.name = name
+        self.private_key = private_key
+        self.public_key = public_key
+        self.listen_port = listen_port
+        self.fw_mark = fw_mark
+
+    def __repr__(self):
+        return "Device({!r})".format(self.name)
+
+    def as_dict(self):
+        """Return the device the way wireguard_dump() did."""
+        return {
+            'private_key': self.private_key,
+            'public_key': self.public_key,
+            'listen_port': self.listen_port,
+            'fw_mark': self.fw_mark,
+            'peers': {},
+        }
+
+
+class Peer:
+    """A wireguard peer, a row of wireguard_rows()."""
+
+    # latest_handshake is kept as epoch seconds, 0 for never, a datetime per
+    # peer costs more than the rest of the record
+    __slots__ = ("device", "public_key", "preshared_key", "endpoint", "allowed_ips",
+                 "latest_handshake", "transfer_rx", "transfer_tx", "persistent_keepalive")
+
+    def __init__(self, device, public_key, preshared_key, endpoint, allowed_ips,
+                 latest_handshake, transfer_rx, transfer_tx, persistent_keepalive):
+        self.device = device
+        self.public_key = public_key
+        self.preshared_key = preshared_key
+        self.endpoint = endpoint
+        self.allowed_ips = allowed_ips
+        self.latest_handshake = latest_handshake
+        self.transfer_rx = transfer_rx
+        self.transfer_tx = transfer_tx
+        self.persistent_keepalive = persistent_keepalive
+
+    def __repr__(self):
+        return "Peer({!r}, {!r})".format(self.device, self.public_key)
+
+    def networks(self):
+        """Return the allowed IPs as ipaddress network objects."""
+        # Parsed on demand, most consumers only need the strings
+        from ipaddress import ip_network
+        return tuple(ip_network(allowed_ip, strict=False) for allowed_ip in self.allowed_ips)
+
+    def handshake_time(self):
+        """Return the latest handshake as a datetime, None for never."""
+        return datetime.fromtimestamp(self.latest_handshake) if self.latest_handshake else None
+
+    def as_dict(self):
+        """Return the peer the way wireguard_dump() did."""
+        return {
+            'preshared_key': self.preshared_key,
+            'endpoint': self.endpoint,
+            'allowed_ips': list(self.allowed_ips),
+            'latest_handshake': datetime.fromtimestamp(self.latest_handshake) if self.latest_handshake else None,
+            'transfer_rx': self.transfer_rx,
+            'transfer_tx': self.transfer_tx,
+            'persistent_keepalive': self.persistent_keepalive,
+        }
+
+
+def parse_messages(data):
+    """Yield (type, flags, seq, payload) for each netlink message in data."""
+    data = memoryview(data)
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, kind, flags, seq, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield kind, flags, seq, data[offset + NLMSGHDR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def parse_attrs(data, offset=0):
+    """Yield (type, value) for each netlink attribute in data."""
+    while offset + NLATTR.size <= len(data):
+        length, kind = NLATTR.unpack_from(data, offset)
+        if length < NLATTR.size:
+            break
+        yield kind & NLA_TYPE_MASK, data[offset + NLATTR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def pack_attr(kind, value):
+    """Return a netlink attribute, padded to 4 bytes."""
+    length = NLATTR.size + len(value)
+    return NLATTR.pack(length, kind) + value + bytes(-length & 3)
+
+
+def format_key(value):
+    """Return a key the way wg prints it, None for a missing key."""
+    if value is None or value == EMPTY_KEY:
+        return None
+    return b64encode(value).decode()
+
+
+def format_endpoint(value):
+    """Return a sockaddr_in or sockaddr_in6 the way wg prints it."""
+    family = U16.unpack_from(value)[0]
+    port = struct.unpack_from("!H", value, 2)[0]
+    if family == socket.AF_INET:
+        return "{}:{}".format(socket.inet_ntop(family, value[4:8]), port)
+    if family == socket.AF_INET6:
+        address = socket.inet_ntop(family, value[8:24])
+        scope_id = U32.unpack_from(value, 24)[0]
+        if scope_id:
+            try:
+                address = "{}%{}".format(address, socket.if_indextoname(scope_id))
+            except OSError:
+                address = "{}%{}".format(address, scope_id)
+        return "[{}]:{}".format(address, port)
+    return None
+
+
+def attr_table(data, offset=0):
+    """Return a dict of netlink attribute type to value, the last one wins."""
+    # One loop instead of a generator, this runs for every peer
+    table = {}
+    end = len(data)
+    unpack = NLATTR.unpack_from
+    while offset + NLATTR.size <= end:
+        length, kind = unpack(data, offset)
+        if length < NLATTR.size:
+            break
+        table[kind & NLA_TYPE_MASK] = data[offset + NLATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return table
+
+
+def parse_allowed_ip(data):
+    """Return one nested allowed IP as an address/cidr string, None if incomplete."""
+    attrs = attr_table(data)
+    family = attrs.get(WGALLOWEDIP_A_FAMILY)
+    address = attrs.get(WGALLOWEDIP_A_IPADDR)
+    cidr = attrs.get(WGALLOWEDIP_A_CIDR_MASK)
+    if family is None or address is None or cidr is None:
+        return None
+    return "{}/{}".format(socket.inet_ntop(U16.unpack_from(family)[0], address), cidr[0])
+
+
+def parse_allowed_ips(data):
+    """Return the nested allowed IPs as a tuple of address/cidr strings."""
+    # Allowed IPs laid out the way the kernel writes them are read with one
+    # unpack each, anything else is parsed attribute by attribute
+    allowed_ips = []
+    offset = 0
+    end = len(data)
+    while offset + NLATTR.size <= end:
+        length = NLATTR.unpack_from(data, offset)[0]
+        if length < NLATTR.size:
+            break
+        start = offset + NLATTR.size
+        offset += (length + 3) & ~3
+        layout = ALLOWEDIP_LAYOUTS.get(length - NLATTR.size)
+        if layout is not None:
+            family, fields = layout
+            fields = fields.unpack_from(data, start)
+            if (fields[1] == WGALLOWEDIP_A_FAMILY and fields[2] == family
+                    and fields[4] == WGALLOWEDIP_A_IPADDR and fields[7] == WGALLOWEDIP_A_CIDR_MASK):
+                allowed_ips.append("{}/{}".format(socket.inet_ntop(family, fields[5]), fields[8]))
+                continue
+        allowed_ip = parse_allowed_ip(data[start:start + length - NLATTR.size])
+        if allowed_ip is not None:
+            allowed_ips.append(allowed_ip)
+    return tuple(allowed_ips)
+
+
+def parse_peer(device, data):
+    """Return the Peer record for a nested peer."""
+    attrs = attr_table(data)
+    get = attrs.get
+    endpoint = get(WGPEER_A_ENDPOINT)
+    keepalive = get(WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL)
+    handshake = get(WGPEER_A_LAST_HANDSHAKE_TIME)
+    rx = get(WGPEER_A_RX_BYTES)
+    tx = get(WGPEER_A_TX_BYTES)
+    allowed_ips = get(WGPEER_A_ALLOWEDIPS)
+    return Peer(device,
+                format_key(get(WGPEER_A_PUBLIC_KEY)),
+                format_key(get(WGPEER_A_PRESHARED_KEY)),
+                None if endpoint is None else format_endpoint(endpoint),
+                () if allowed_ips is None else parse_allowed_ips(allowed_ips),
+                # struct __kernel_timespec, wg only prints the seconds
+                0 if handshake is None else struct.unpack_from("=q", handshake)[0],
+                0 if rx is None else U64.unpack_from(rx)[0],
+                0 if tx is None else U64.unpack_from(tx)[0],
+                None if keepalive is None else U16.unpack_from(keepalive)[0] or None)
+
+
+def device_rows(device, payloads):
+    """Yield Device and Peer rows from the WG_CMD_GET_DEVICE replies of one device."""
+    # payloads are the generic netlink payloads, genlmsghdr included, so
+    # captured replies can be replayed without a kernel module
+    entry = None
+    listen_port = fw_mark = 0
+    last_peer = None
+    for payload in payloads:
+        peers = b""
+        keys = {}
+        for kind, value in parse_attrs(payload, GENLMSGHDR.size):
+            if kind == WGDEVICE_A_PEERS:
+                peers = value
+            elif kind in (WGDEVICE_A_PRIVATE_KEY, WGDEVICE_A_PUBLIC_KEY):
+                keys[kind] = bytes(value)
+            elif entry is None and kind == WGDEVICE_A_LISTEN_PORT:
+                listen_port = U16.unpack_from(value)[0]
+            elif entry is None and kind == WGDEVICE_A_FWMARK:
+                fw_mark = U32.unpack_from(value)[0]
+
+        if entry is None:
+            # Only the first message carries the device attributes
+            entry = Device(device, format_key(keys.get(WGDEVICE_A_PRIVATE_KEY)),
+                           format_key(keys.get(WGDEVICE_A_PUBLIC_KEY)), listen_port,
+                           fw_mark or None)
+            yield entry
+
+        for _, nested in parse_attrs(peers):
+            peer = parse_peer(device, nested)
+            if last_peer is not None and peer.public_key == last_peer.public_key:
+                # Continuation of the last peer, only more allowed IPs
+                last_peer.allowed_ips += peer.allowed_ips
+                continue
+            if last_peer is not None:
+                yield last_peer
+            last_peer = peer
+
+    if last_peer is not None:
+        yield last_peer
+
+
+def wireguard_devices(sysfs=SYSFS_NET):
+    """Return the names of the wireguard interfaces."""
+    devices = []
+    for name in sorted(os.listdir(sysfs)):
+        try:
+            with open(path.join(sysfs, name, "uevent"), "r") as f:
+                if "DEVTYPE=wireguard\n" in f.read():
+                    devices.append(name)
+        except OSError:
+            # Interface went away
+            continue
+    return devices
+
+
+class WireGuardNetlink:
+    """Generic netlink socket bound to the wireguard family."""
+
+    def __init__(self):
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        try:
+            self.sock.bind((0, 0))
+            self.family = self.resolve_family(WG_GENL_NAME)
+        except Exception:
+            self.sock.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, family, command, version, attrs, flags=0):
+        """Send a request and yield the payload of each reply."""
+        self.seq += 1
+        seq = self.seq
+        payload = GENLMSGHDR.pack(command, version, 0) + attrs
+        self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), family,
+                                     NLM_F_REQUEST | flags, seq, 0) + payload)
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            for kind, msg_flags, msg_seq, payload in parse_messages(data):
+                if msg_seq != seq:
+                    # Left over from an abandoned request
+                    continue
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", payload)[0]
+                    if error:
+                        raise OSError(error, os.strerror(error))
+                    return
+                yield payload
+                if not msg_flags & NLM_F_MULTI:
+                    return
+
+    def resolve_family(self, name):
+        """Return the generic netlink family id for name."""
+        attrs = pack_attr(CTRL_ATTR_FAMILY_NAME, name + b"\0")
+        for payload in self.request(GENL_ID_CTRL, CTRL_CMD_GETFAMILY, 1, attrs):
+            for kind, value in parse_attrs(payload, GENLMSGHDR.size):
+                if kind == CTRL_ATTR_FAMILY_ID:
+                    return U16.unpack_from(value)[0]
+        raise OSError("generic netlink family {} not found".format(name.decode()))
+
+    def rows(self, devices=None):
+        """Yield Device and Peer rows for all or the given devices."""
+        for device in wireguard_devices() if devices is None else devices:
+            attrs = pack_attr(WGDEVICE_A_IFNAME, device.encode() + b"\0")
+            payloads = self.request(self.family, WG_CMD_GET_DEVICE, WG_GENL_VERSION,
+                                    attrs, NLM_F_DUMP)
+            try:
+                yield from device_rows(device, payloads)
+            except OSError as e:
+                if e.errno != ENODEV:
+                    raise
+                # Interface removed after listing it
+
+
+def parse_dump(lines):
+    """Yield Device and Peer rows from the lines of `wg show all dump`."""
+    # Device lines have 5 fields and peer lines 9, each line is split once
+    # and every field converted in place
+    device = None
+    for line in lines:
+        items = line.rstrip('\n').split('\t')
+
+        if len(items) == 9:
+            # A peer of the last device, all peers share its name string
+            _, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx, persistent_keepalive = items
+            yield Peer(
+                device,
+                public_key,
+                None if preshared_key == '(none)' else preshared_key,
+                None if endpoint == '(none)' else endpoint,
+                () if allowed_ips == '(none)' else tuple(allowed_ips.split(',')),
+                int(latest_handshake),
+                int(transfer_rx),
+                int(transfer_tx),
+                None if persistent_keepalive == 'off' else int(persistent_keepalive))
+        elif len(items) == 5:
+            # We are entering a new device
+            device, private_key, public_key, listen_port, fw_mark = items
+            yield Device(
+                device,
+                None if private_key == '(none)' else private_key,
+                None if public_key == '(none)' else public_key,
+                int(listen_port),
+                None if fw_mark == 'off' else int(fw_mark))
+
+
+def wg_rows():
+    """Yield Device and Peer rows while `wg show all dump` is running."""
+    # Read the pipe line by line so only one line is held at a time, leaving
+    # early closes the pipe and wg goes away on SIGPIPE
+    with subprocess.Popen(["wg", "show", "all", "dump"], stdout=subprocess.PIPE,
+                          universal_newlines=True) as process:
+        yield from parse_dump(process.stdout)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def wireguard_rows():
+    """Yield a Device row for each interface followed by a Peer row per peer."""
+    try:
+        netlink = WireGuardNetlink()
+    except OSError:
+        # No netlink access or no wireguard module loaded, ask wg
+        yield from wg_rows()
+        return
+    with netlink:
+        # Resolving the family is allowed to anyone, dumping a device needs
+        # CAP_NET_ADMIN and fails with EPERM before the first row
+        started = False
+        try:
+            for row in netlink.rows():
+                started = True
+                yield row
+            return
+        except PermissionError:
+            if started:
+                raise
+    yield from wg_rows()
+
+
+def wireguard_peers():
+    """Yield a Peer record for each peer as it is read."""
+    for record in wireguard_rows():
+        if isinstance(record, Peer):
+            yield record
+
+
+class PeerChange:
+    """A peer that changed between two polls of WireGuardPoller."""
+
+    __slots__ = ("peer", "new", "reset", "rx_rate", "tx_rate", "handshake_age")
+
+    def __init__(self, peer, new, reset, rx_rate, tx_rate, handshake_age):
+        self.peer = peer
+        self.new = new
+        self.reset = reset
+        self.rx_rate = rx_rate
+        self.tx_rate = tx_rate
+        self.handshake_age = handshake_age
+
+    def __repr__(self):
+        return "PeerChange({!r}, rx_rate={!r}, tx_rate={!r})".format(
+            self.peer, self.rx_rate, self.tx_rate)
+
+
+class WireGuardPoller:
+    """Poll the peers and report only what changed since the last poll."""
+
+    def __init__(self, rows=wireguard_rows):
+        # rows is called on each poll, returning Device and Peer rows
+        self.rows = rows
+        self.peers = {}
+        self.last_poll = None
+
+    def poll(self):
+        """Return a list of PeerChange and a list of removed (device, public key)."""
+        # Rates are in bytes per second, None on the first poll of a peer
+        now = monotonic()
+        wall = time()
+        interval = None if self.last_poll is None else now - self.last_poll
+        previous = self.peers
+        peers = {}
+        changed = []
+        for peer in self.rows():
+            if not isinstance(peer, Peer):
+                continue
+            key = (peer.device, peer.public_key)
+            peers[key] = peer
+            old = previous.get(key)
+            if (old is not None
+                    and old.transfer_rx == peer.transfer_rx
+                    and old.transfer_tx == peer.transfer_tx
+                    and old.latest_handshake == peer.latest_handshake
+                    and old.endpoint == peer.endpoint
+                    and old.allowed_ips == peer.allowed_ips):
+                continue
+
+            rx_rate = tx_rate = None
+            reset = False
+            if old is not None and interval:
+                # Counters going back means the peer or interface was
+                # recreated, count from zero
+                rx_old, tx_old = old.transfer_rx, old.transfer_tx
+                if peer.transfer_rx < rx_old or peer.transfer_tx < tx_old:
+                    reset = True
+                    rx_old = tx_old = 0
+                rx_rate = (peer.transfer_rx - rx_old) / interval
+                tx_rate = (peer.transfer_tx - tx_old) / interval
+            handshake_age = wall - peer.latest_handshake if peer.latest_handshake else None
+            changed.append(PeerChange(peer, old is None, reset, rx_rate, tx_rate, handshake_age))
+
+        # Whatever was not seen again is gone, the state is only replaced once
+        # all rows were read so a failing poll leaves the last one in place
+        removed = [key for key in previous if key not in peers]
+        self.peers = peers
+        self.last_poll = now
+        return changed, removed
+
+
+class AllowedIPsTrie:
+    """Longest prefix match of an address to the peer allowing it."""
+
+    def __init__(self, peers=()):
+        # A binary trie per IP version, nodes are [zero, one, owners] where
+        # owners lists the (device, public key) allowing the prefix, the same
+        # prefix can be on several devices and the last added one wins
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.peers = {}
+        for peer in peers:
+            self.add(peer)
+
+    def __len__(self):
+        return len(self.peers)
+
+    @staticmethod
+    def _prefixes(peer):
+        """Return (version, prefix bits, prefix length) for the allowed IPs of peer."""
+        return [(network.version,
+                 int(network.network_address) >> (network.max_prefixlen - network.prefixlen),
+                 network.prefixlen)
+                for network in peer.networks()]
+
+    def add(self, peer):
+        """Add peer or replace the last seen version of it."""
+        key = (peer.device, peer.public_key)
+        old = self.peers.get(key)
+        if old is not None and old[0].allowed_ips == peer.allowed_ips:
+            # Same allowed IPs, only the record changes
+            self.peers[key] = (peer, old[1])
+            return
+        if old is not None:
+            self.remove(*key)
+
+        prefixes = self._prefixes(peer)
+        for version, bits, length in prefixes:
+            node = self.roots[version]
+            for shift in range(length - 1, -1, -1):
+                bit = bits >> shift & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+            if node[2] is None:
+                node[2] = [key]
+            else:
+                node[2].append(key)
+        self.peers[key] = (peer, prefixes)
+
+    def remove(self, device, public_key):
+        """Remove a peer, unknown peers are ignored."""
+        key = (device, public_key)
+        entry = self.peers.pop(key, None)
+        if entry is None:
+            return
+        for version, bits, length in entry[1]:
+            node = self.roots[version]
+            trail = []
+            for shift in range(length - 1, -1, -1):
+                bit = bits >> shift & 1
+                trail.append((node, bit))
+                node = node[bit]
+                if node is None:
+                    break
+            else:
+                if node[2] is not None and key in node[2]:
+                    node[2].remove(key)
+                    if not node[2]:
+                        node[2] = None
+                # Drop nodes left without children or a peer
+                for parent, bit in reversed(trail):
+                    child = parent[bit]
+                    if child[0] is not None or child[1] is not None or child[2] is not None:
+                        break
+                    parent[bit] = None
+
+    def update(self, changed, removed):
+        """Apply the result of WireGuardPoller.poll()."""
+        for change in changed:
+            self.add(change.peer)
+        for key in removed:
+            self.remove(*key)
+
+    def lookup(self, address):
+        """Return (device, Peer) allowing address, None if no peer does."""
+        from ipaddress import ip_address
+        address = ip_address(address)
+        value = int(address)
+        node = self.roots[address.version]
+        owners = node[2]
+        for shift in range(address.max_prefixlen - 1, -1, -1):
+            node = node[value >> shift & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                owners = node[2]
+        if owners is None:
+            return None
+        key = owners[-1]
+        return key[0], self.peers[key][0]
+
+
+def wireguard_dump(rows=wireguard_rows):
     """Dump wireguard data in a python friendly way."""
-    last_device=None
+    # This loop runs once per peer, so the peer dicts are built here instead
+    # of with Peer.as_dict(), and peers with a handshake in the same second
+    # share one datetime, active peers handshake every two minutes
     output = {}
-    
-    # Dump wireguard connection data
-    _f = subprocess.check_output(["wg", "show", "all", "dump"]).decode()
-    for line in _f.split('\n'):
-        if not line:
-          # Skip empty lines and last line
-          continue
-        items = line.split('\t')
-
-        if last_device != items[0]:
-            # We are currently entering a new node
-            device, private_key, public_key, listen_port, fw_mark = items
-            last_device = device
-            
-            output[device] = {
-                'private_key': None if private_key == '(none)' else private_key,
-                'public_key': None if public_key == '(none)' else public_key,
-                'listen_port': int(listen_port),
-                'fw_mark': None if fw_mark == 'off' else int(fw_mark),
-                'peers': {},
-                } 
+    peers = None
+    handshakes = {0: None}
+    for record in rows():
+        if isinstance(record, Peer):
+            try:
+                handshake = handshakes[record.latest_handshake]
+            except KeyError:
+                handshake = handshakes[record.latest_handshake] = datetime.fromtimestamp(
+                    record.latest_handshake)
+            peers[record.public_key] = {
+                'preshared_key': record.preshared_key,
+                'endpoint': record.endpoint,
+                'allowed_ips': list(record.allowed_ips),
+                'latest_handshake': handshake,
+                'transfer_rx': record.transfer_rx,
+                'transfer_tx': record.transfer_tx,
+                'persistent_keepalive': record.persistent_keepalive,
+            }
         else:
-            # We are entering a peer
-            device, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx, persistent_keepalive = items
-            if allowed_ips == '(none)':
-                allowed_ips = []
-            else:
-                allowed_ips = allowed_ips.split('\t')
-            output[device][public_key] = {
-                'preshared_key': None if preshared_key == '(none)' else preshared_key,
-                'endpoint': None if endpoint == '(none)' else endpoint,
-                'allowed_ips': allowed_ips,
-                'latest_handshake': None if latest_handshake == '0' else datetime.fromtimestamp(int(latest_handshake)),
-                'transfer_rx': int(transfer_rx),
-                'transfer_tx': int(transfer_tx),
-                'persistent_keepalive': None if persistent_keepalive == 'off' else int(persistent_keepalive),
-           } 
+            device = output[record.name] = record.as_dict()
+            peers = device['peers']
     return output
-            
+
 if __name__ == "__main__":
     import json
 
     def myconverter(o):
         if isinstance(o, datetime):
             return o.__str__()
-    
+
     print(json.dumps(wireguard_dump(), indent=4, default=myconverter))
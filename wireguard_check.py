@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""Replay check and benchmarks for the wireguard netlink parser."""
+
+import argparse
+import gc
+import random
+import socket
+import struct
+import sys
+import time
+import tracemalloc
+from base64 import b64encode
+from datetime import datetime
+from errno import EACCES, ENODEV, EPERM, errorcode
+from ipaddress import ip_address, ip_network
+
+import wireguard
+from wireguard import (GENLMSGHDR, NLMSGHDR, NLMSG_DONE, NLMSG_ERROR, NLM_F_MULTI,
+                       U16, U32, U64, pack_attr)
+
+# Family id the fake socket answers for, any unused id works
+FAMILY = 0x20
+PRIVATE_KEY = bytes(range(32))
+PUBLIC_KEY = bytes(range(1, 33))
+PEER_KEYS = [bytes([i]) * 32 for i in (0xA1, 0xB2, 0xC3)]
+PRESHARED_KEY = bytes([0x5A]) * 32
+NLA_F_NESTED = 0x8000
+
+"""Check workflow
+1: build the replies the kernel sends for a WG_CMD_GET_DEVICE dump of wg0,
+   split over three messages: the first carries the device attributes and
+   peer A, the second continues peer A with an IPv6 allowed IP and adds
+   peer B, the third continues peer B with an allowed IP whose attributes
+   are not in kernel order and adds peer C that has no endpoint and no
+   allowed IPs
+
+2: frame them like recv() returns them, a stale reply of an earlier request
+   with an unaligned length first, the messages spread over two reads and
+   NLMSG_DONE in a third, then an ENODEV error for wg1 that went away
+
+3: replay the reads through WireGuardNetlink.rows() with a fake socket and
+   compare the rows with parse_dump() of the same devices in the
+   `wg show all dump` format
+
+4: answer the dump request with EPERM and with EACCES, wireguard_rows()
+   returns the rows of `wg show all dump` instead
+
+5: add, replace and remove random peers in an AllowedIPsTrie, their prefixes
+   overlap and include /0, /32 and /128, and compare lookups of random IPv4
+   and IPv6 addresses with a linear longest prefix scan of the same peers
+
+With --dump wireguard_dump() is timed on a synthetic device with that many
+peers, read from `wg show all dump` text and from netlink replies, next to
+the wireguard_dump() this module started from on the same text.
+
+With --memory the memory held by the Device and Peer records of a synthetic
+device is measured with tracemalloc, next to the dicts the wireguard_dump()
+this module started from kept for the same peers.
+
+With --trie AllowedIPsTrie is built for that many peers and its lookups are
+timed next to the linear scan of the check.
+"""
+
+WG_DUMP = """\
+wg0\t{private}\t{public}\t51820\t16
+wg0\t{a}\t{psk}\t192.0.2.1:51820\t10.0.0.0/24,10.1.0.1/32,fd00::/64\t1700000000\t1024\t2048\t25
+wg0\t{b}\t(none)\t[2001:db8::1]:51821\t::/0,0.0.0.0/0,198.51.100.16/28\t1700000100\t0\t0\toff
+wg0\t{c}\t(none)\t(none)\t(none)\t0\t0\t0\toff
+"""
+
+
+def key(value):
+    """Return a key the way wg prints it."""
+    return b64encode(value).decode()
+
+
+def nested(kind, *attrs):
+    """Return a nested netlink attribute."""
+    return pack_attr(kind | NLA_F_NESTED, b"".join(attrs))
+
+
+def sockaddr(family, address, port):
+    """Return a sockaddr_in or sockaddr_in6 as the kernel sends it."""
+    if family == socket.AF_INET:
+        return (U16.pack(family) + struct.pack("!H", port) + socket.inet_pton(family, address)
+                + bytes(8))
+    return (U16.pack(family) + struct.pack("!H", port) + U32.pack(0)
+            + socket.inet_pton(family, address) + U32.pack(0))
+
+
+def allowed_ips(*networks):
+    """Return a WGPEER_A_ALLOWEDIPS attribute for address/cidr strings."""
+    attrs = []
+    for network in networks:
+        address, _, cidr = network.partition("/")
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        attrs.append(nested(0,
+                            pack_attr(wireguard.WGALLOWEDIP_A_FAMILY, U16.pack(family)),
+                            pack_attr(wireguard.WGALLOWEDIP_A_IPADDR,
+                                      socket.inet_pton(family, address)),
+                            pack_attr(wireguard.WGALLOWEDIP_A_CIDR_MASK, bytes([int(cidr)]))))
+    return nested(wireguard.WGPEER_A_ALLOWEDIPS, *attrs)
+
+
+def device_message(*attrs):
+    """Return the generic netlink payload of one WG_CMD_GET_DEVICE reply."""
+    return (GENLMSGHDR.pack(wireguard.WG_CMD_GET_DEVICE, wireguard.WG_GENL_VERSION, 0)
+            + pack_attr(wireguard.WGDEVICE_A_IFNAME, b"wg0\0") + b"".join(attrs))
+
+
+def message(kind, flags, seq, payload):
+    """Return a netlink message, padded to 4 bytes."""
+    length = NLMSGHDR.size + len(payload)
+    return NLMSGHDR.pack(length, kind, flags, seq, 0) + payload + bytes(-length & 3)
+
+
+def replies():
+    """Return the payloads of the wg0 dump."""
+    peer_a = nested(0,
+                    pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, PEER_KEYS[0]),
+                    pack_attr(wireguard.WGPEER_A_PRESHARED_KEY, PRESHARED_KEY),
+                    pack_attr(wireguard.WGPEER_A_ENDPOINT,
+                              sockaddr(socket.AF_INET, "192.0.2.1", 51820)),
+                    pack_attr(wireguard.WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, U16.pack(25)),
+                    pack_attr(wireguard.WGPEER_A_LAST_HANDSHAKE_TIME,
+                              struct.pack("=qq", 1700000000, 123456789)),
+                    pack_attr(wireguard.WGPEER_A_RX_BYTES, U64.pack(1024)),
+                    pack_attr(wireguard.WGPEER_A_TX_BYTES, U64.pack(2048)),
+                    allowed_ips("10.0.0.0/24", "10.1.0.1/32"))
+    # The kernel repeats the public key of a peer continued from the last message
+    peer_a_continued = nested(0,
+                              pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, PEER_KEYS[0]),
+                              allowed_ips("fd00::/64"))
+    peer_b = nested(0,
+                    pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, PEER_KEYS[1]),
+                    pack_attr(wireguard.WGPEER_A_PRESHARED_KEY, bytes(32)),
+                    pack_attr(wireguard.WGPEER_A_ENDPOINT,
+                              sockaddr(socket.AF_INET6, "2001:db8::1", 51821)),
+                    pack_attr(wireguard.WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, U16.pack(0)),
+                    pack_attr(wireguard.WGPEER_A_LAST_HANDSHAKE_TIME,
+                              struct.pack("=qq", 1700000100, 0)),
+                    allowed_ips("::/0", "0.0.0.0/0"))
+    # Attributes in another order than the kernel writes them
+    reordered = nested(wireguard.WGPEER_A_ALLOWEDIPS, nested(
+        0,
+        pack_attr(wireguard.WGALLOWEDIP_A_CIDR_MASK, bytes([28])),
+        pack_attr(wireguard.WGALLOWEDIP_A_IPADDR, socket.inet_pton(socket.AF_INET, "198.51.100.16")),
+        pack_attr(wireguard.WGALLOWEDIP_A_FAMILY, U16.pack(socket.AF_INET))))
+    peer_c = nested(0, pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, PEER_KEYS[2]))
+    return [
+        device_message(pack_attr(wireguard.WGDEVICE_A_PRIVATE_KEY, PRIVATE_KEY),
+                       pack_attr(wireguard.WGDEVICE_A_PUBLIC_KEY, PUBLIC_KEY),
+                       pack_attr(wireguard.WGDEVICE_A_LISTEN_PORT, U16.pack(51820)),
+                       pack_attr(wireguard.WGDEVICE_A_FWMARK, U32.pack(16)),
+                       nested(wireguard.WGDEVICE_A_PEERS, peer_a)),
+        device_message(nested(wireguard.WGDEVICE_A_PEERS, peer_a_continued, peer_b)),
+        device_message(nested(wireguard.WGDEVICE_A_PEERS,
+                              nested(0, pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, PEER_KEYS[1]),
+                                     reordered),
+                              peer_c)),
+    ]
+
+
+class ReplaySocket:
+    """Socket returning recorded reads, one per recv() call."""
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+    def recv(self, size):
+        return self.reads.pop(0)
+
+    def close(self):
+        pass
+
+
+def replay_rows():
+    """Return the rows WireGuardNetlink.rows() reads from the recorded replies."""
+    payloads = replies()
+    reads = [
+        # wg0 is the first request, sequence number 1
+        message(FAMILY, NLM_F_MULTI, 0, b"stale") + message(FAMILY, NLM_F_MULTI, 1, payloads[0]),
+        message(FAMILY, NLM_F_MULTI, 1, payloads[1]) + message(FAMILY, NLM_F_MULTI, 1, payloads[2]),
+        message(NLMSG_DONE, NLM_F_MULTI, 1, U32.pack(0)),
+        # wg1 was removed before it was asked for
+        message(NLMSG_ERROR, 0, 2, struct.pack("=i", -ENODEV) + bytes(NLMSGHDR.size)),
+    ]
+    netlink = wireguard.WireGuardNetlink.__new__(wireguard.WireGuardNetlink)
+    netlink.seq = 0
+    netlink.sock = ReplaySocket(reads)
+    netlink.family = FAMILY
+    rows = list(netlink.rows(["wg0", "wg1"]))
+    if netlink.sock.reads:
+        raise AssertionError("{} reads left over".format(len(netlink.sock.reads)))
+    return rows
+
+
+def fallback_rows(error):
+    """Return the rows of wireguard_rows() when the dump request fails with error."""
+    netlink_class = wireguard.WireGuardNetlink
+
+    def denied():
+        netlink = netlink_class.__new__(netlink_class)
+        netlink.seq = 0
+        netlink.sock = ReplaySocket([message(NLMSG_ERROR, 0, 1, struct.pack("=i", -error) + bytes(NLMSGHDR.size))])
+        netlink.family = FAMILY
+        return netlink
+
+    real = (netlink_class, wireguard.wg_rows, wireguard.wireguard_devices)
+    wireguard.WireGuardNetlink = denied
+    wireguard.wg_rows = dump_rows
+    wireguard.wireguard_devices = lambda: ["wg0"]
+    try:
+        return list(wireguard.wireguard_rows())
+    finally:
+        wireguard.WireGuardNetlink, wireguard.wg_rows, wireguard.wireguard_devices = real
+
+
+def dump_rows():
+    """Return the rows parse_dump() reads from the same devices."""
+    text = WG_DUMP.format(private=key(PRIVATE_KEY), public=key(PUBLIC_KEY),
+                          a=key(PEER_KEYS[0]), b=key(PEER_KEYS[1]), c=key(PEER_KEYS[2]),
+                          psk=key(PRESHARED_KEY))
+    return list(wireguard.parse_dump(text.splitlines(True)))
+
+
+def fields(row):
+    """Return the type and slot values of a row."""
+    return (type(row).__name__,) + tuple(getattr(row, slot) for slot in type(row).__slots__)
+
+
+def linear_lookup(peers, address):
+    """Return (device, Peer) allowing address by a scan of every allowed IP."""
+    # peers maps to (Peer, networks) in the order the trie added them, of
+    # equal prefixes the last added one wins
+    address = ip_address(address)
+    best = None
+    best_length = -1
+    for peer, networks in peers.values():
+        for network in networks:
+            if network.version == address.version and address in network and network.prefixlen >= best_length:
+                best = (peer.device, peer)
+                best_length = network.prefixlen
+    return best
+
+
+def random_prefix(rng, version):
+    """Return a random allowed IP, close to others so that prefixes overlap."""
+    bits = 32 if version == 4 else 128
+    # A few bases with random host bits, lengths favour the edge cases
+    base = (rng.randrange(4) << (bits - 8)) | rng.getrandbits(bits - 8)
+    length = rng.choice((0, bits, bits, rng.randint(1, bits - 1), rng.randint(1, 24)))
+    network = ip_network((base, bits)).supernet(new_prefix=length)
+    return str(network)
+
+
+def random_address(rng, version):
+    """Return a random address, most of them in the space random_prefix() uses."""
+    bits = 32 if version == 4 else 128
+    if rng.random() < 0.8:
+        value = (rng.randrange(4) << (bits - 8)) | rng.getrandbits(bits - 8)
+    else:
+        value = rng.getrandbits(bits)
+    return str(ip_address(value) if version == 4 else ip_address(value.to_bytes(16, "big")))
+
+
+def random_peer(rng, index):
+    """Return a Peer with random IPv4 and IPv6 allowed IPs."""
+    allowed_ips = tuple(random_prefix(rng, rng.choice((4, 6))) for _ in range(rng.randint(0, 4)))
+    return wireguard.Peer(rng.choice(("wg0", "wg1")), key(peer_key(index)), None, None,
+                          allowed_ips, 0, 0, 0, None)
+
+
+def check_trie(seed=1, rounds=400, lookups=20):
+    """Compare AllowedIPsTrie lookups with linear_lookup(), return the differences."""
+    rng = random.Random(seed)
+    trie = wireguard.AllowedIPsTrie()
+    peers = {}
+    problems = []
+    for i in range(rounds):
+        action = rng.random()
+        if action < 0.15 and peers:
+            device, public_key = rng.choice(list(peers))
+            trie.remove(device, public_key)
+            del peers[device, public_key]
+        else:
+            # Mostly new peers, sometimes a new version of a known peer
+            if action < 0.3 and peers:
+                old = peers[rng.choice(list(peers))][0]
+                peer = random_peer(rng, 0)
+                peer.device, peer.public_key = old.device, old.public_key
+                if rng.random() < 0.5:
+                    peer.allowed_ips = old.allowed_ips
+            else:
+                peer = random_peer(rng, i)
+            old = peers.get((peer.device, peer.public_key))
+            if old is None or old[0].allowed_ips != peer.allowed_ips:
+                # A replaced peer with new allowed IPs moves to the end
+                peers.pop((peer.device, peer.public_key), None)
+            peers[peer.device, peer.public_key] = (peer, peer.networks())
+            trie.add(peer)
+
+        for _ in range(lookups):
+            address = random_address(rng, rng.choice((4, 6)))
+            want = linear_lookup(peers, address)
+            have = trie.lookup(address)
+            if want != have:
+                problems.append("round {}: {} found {}, expected {}".format(
+                    i, address, have and have[1], want and want[1]))
+    if len(trie) != len(peers):
+        problems.append("trie holds {} peers, expected {}".format(len(trie), len(peers)))
+    return problems
+
+
+def check():
+    """Compare the replayed rows and trie lookups with the expected ones, return the differences."""
+    expected = [fields(row) for row in dump_rows()]
+    got = [fields(row) for row in replay_rows()]
+    problems = []
+    for i in range(max(len(expected), len(got))):
+        want = expected[i] if i < len(expected) else None
+        have = got[i] if i < len(got) else None
+        if want != have:
+            problems.append("row {}: got {}, expected {}".format(i, have, want))
+    for error in (EPERM, EACCES):
+        try:
+            rows = [fields(row) for row in fallback_rows(error)]
+        except OSError as e:
+            rows = e
+        if rows != expected:
+            problems.append("{} from the dump request: got {}, expected the rows of wg".format(
+                errorcode[error], rows))
+    problems.extend(check_trie())
+    return problems
+
+
+def baseline_dump(output_text):
+    """Return wireguard_dump() as it was before the rewrite, for the text wg printed."""
+    # Kept as it was apart from reading the text instead of running wg, peers
+    # land next to 'peers' instead of in it
+    last_device = None
+    output = {}
+    for line in output_text.split('\n'):
+        if not line:
+            continue
+        items = line.split('\t')
+
+        if last_device != items[0]:
+            device, private_key, public_key, listen_port, fw_mark = items
+            last_device = device
+            output[device] = {
+                'private_key': None if private_key == '(none)' else private_key,
+                'public_key': None if public_key == '(none)' else public_key,
+                'listen_port': int(listen_port),
+                'fw_mark': None if fw_mark == 'off' else int(fw_mark),
+                'peers': {},
+            }
+        else:
+            device, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx, persistent_keepalive = items
+            if allowed_ips == '(none)':
+                allowed_ips = []
+            else:
+                allowed_ips = allowed_ips.split('\t')
+            output[device][public_key] = {
+                'preshared_key': None if preshared_key == '(none)' else preshared_key,
+                'endpoint': None if endpoint == '(none)' else endpoint,
+                'allowed_ips': allowed_ips,
+                'latest_handshake': None if latest_handshake == '0' else datetime.fromtimestamp(int(latest_handshake)),
+                'transfer_rx': int(transfer_rx),
+                'transfer_tx': int(transfer_tx),
+                'persistent_keepalive': None if persistent_keepalive == 'off' else int(persistent_keepalive),
+            }
+    return output
+
+
+def peer_key(i):
+    """Return the public key of synthetic peer number i."""
+    # An all zero key reads as no key
+    return struct.pack("!I", i + 1) * 8
+
+
+def peer_address6(i):
+    """Return the IPv6 address of synthetic peer number i, the way wg prints it."""
+    return "fd00:{:x}::{:x}".format((i >> 15) + 1, (i & 0x7FFF) + 1)
+
+
+def synthetic_dump(count, now=1700000000):
+    """Return `wg show all dump` text for wg0 with count peers."""
+    # One peer in ten never did a handshake, the others did one in the last
+    # three minutes, like active peers that rekey every two minutes
+    lines = ["wg0\t{}\t{}\t51820\toff\n".format(key(PRIVATE_KEY), key(PUBLIC_KEY))]
+    for i in range(count):
+        lines.append("wg0\t{}\t(none)\t198.51.{}.{}:51820\t10.{}.{}.0/24,{}/128\t{}\t{}\t{}\t25\n".format(
+            key(peer_key(i)), i >> 8 & 0xFF, i & 0xFF, i >> 8 & 0xFF, i & 0xFF, peer_address6(i),
+            0 if i % 10 == 0 else now - i % 180, i * 7, i * 11))
+    return "".join(lines)
+
+
+def synthetic_replies(count, now=1700000000, per_message=100):
+    """Return the WG_CMD_GET_DEVICE payloads for the peers of synthetic_dump()."""
+    payloads = []
+    for first in range(0, count, per_message):
+        peers = []
+        for i in range(first, min(count, first + per_message)):
+            peers.append(nested(
+                0,
+                pack_attr(wireguard.WGPEER_A_PUBLIC_KEY, peer_key(i)),
+                pack_attr(wireguard.WGPEER_A_PRESHARED_KEY, bytes(32)),
+                pack_attr(wireguard.WGPEER_A_ENDPOINT, sockaddr(
+                    socket.AF_INET, "198.51.{}.{}".format(i >> 8 & 0xFF, i & 0xFF), 51820)),
+                pack_attr(wireguard.WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, U16.pack(25)),
+                pack_attr(wireguard.WGPEER_A_LAST_HANDSHAKE_TIME, struct.pack(
+                    "=qq", 0 if i % 10 == 0 else now - i % 180, 0)),
+                pack_attr(wireguard.WGPEER_A_RX_BYTES, U64.pack(i * 7)),
+                pack_attr(wireguard.WGPEER_A_TX_BYTES, U64.pack(i * 11)),
+                allowed_ips("10.{}.{}.0/24".format(i >> 8 & 0xFF, i & 0xFF),
+                            "{}/128".format(peer_address6(i)))))
+        attrs = [nested(wireguard.WGDEVICE_A_PEERS, *peers)]
+        if not payloads:
+            attrs[:0] = [pack_attr(wireguard.WGDEVICE_A_PRIVATE_KEY, PRIVATE_KEY),
+                         pack_attr(wireguard.WGDEVICE_A_PUBLIC_KEY, PUBLIC_KEY),
+                         pack_attr(wireguard.WGDEVICE_A_LISTEN_PORT, U16.pack(51820))]
+        payloads.append(device_message(*attrs))
+    return payloads
+
+
+def best_time(function, repeat):
+    """Return the shortest of repeat runs of function, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        function()
+        times.append(time.monotonic() - start)
+    return min(times)
+
+
+def run_dump(args):
+    """Time wireguard_dump() and the rows behind it on a synthetic device."""
+    text = synthetic_dump(args.dump)
+    payloads = synthetic_replies(args.dump)
+    text_rows = lambda: wireguard.parse_dump(text.splitlines(True))
+    netlink_rows = lambda: wireguard.device_rows("wg0", payloads)
+
+    dumped = wireguard.wireguard_dump(text_rows)
+    if dumped != wireguard.wireguard_dump(netlink_rows) or len(dumped["wg0"]["peers"]) != args.dump:
+        raise AssertionError("text and netlink dumps differ")
+
+    timings = [
+        ("baseline wireguard_dump(), text", lambda: baseline_dump(text)),
+        ("wireguard_dump(), text", lambda: wireguard.wireguard_dump(text_rows)),
+        ("wireguard_dump(), netlink", lambda: wireguard.wireguard_dump(netlink_rows)),
+        ("parse_dump() rows only", lambda: list(text_rows())),
+        ("device_rows() rows only", lambda: list(netlink_rows())),
+    ]
+    print("{} peers, best of {}".format(args.dump, args.repeat))
+    for name, function in timings:
+        print("{:<34} {:>8.3f} s".format(name, best_time(function, args.repeat)))
+        sys.stdout.flush()
+
+
+def run_trie(args):
+    """Time building AllowedIPsTrie and its lookups next to linear_lookup()."""
+    # Every peer allows its own /32 and /128 like road warriors do, one in
+    # a hundred routes a /16 and a /48 like site to site peers
+    peers = []
+    for i in range(args.trie):
+        allowed_ips = ["10.{}.{}.{}/32".format(i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF),
+                       "{}/128".format(peer_address6(i))]
+        if i % 100 == 0:
+            allowed_ips += ["172.{}.0.0/16".format(16 + i // 100 % 16), "fd01:{:x}::/48".format(i // 100)]
+        peers.append(wireguard.Peer("wg0", key(peer_key(i)), None, None, tuple(allowed_ips), 0, 0, 0, None))
+    rng = random.Random(1)
+    addresses = [rng.choice(peers).allowed_ips[rng.randrange(2)].split("/")[0] for _ in range(10000)]
+    addresses += ["172.{}.1.1".format(16 + i % 16) for i in range(1000)]
+    addresses += ["192.0.2.1", "2001:db8::1"] * 500
+
+    trie = wireguard.AllowedIPsTrie(peers)
+    linear = {(peer.device, peer.public_key): (peer, peer.networks()) for peer in peers}
+    sample = addresses[::len(addresses) // 100]
+    if [trie.lookup(address) for address in sample] != [linear_lookup(linear, address) for address in sample]:
+        raise AssertionError("trie and linear lookups differ")
+
+    build = best_time(lambda: wireguard.AllowedIPsTrie(peers), args.repeat)
+    lookup = best_time(lambda: [trie.lookup(address) for address in addresses], args.repeat)
+    scan = best_time(lambda: [linear_lookup(linear, address) for address in sample], 1)
+    print("{} peers, {} lookups, best of {}".format(args.trie, len(addresses), args.repeat))
+    print("{:<24} {:>10.3f} s".format("build", build))
+    print("{:<24} {:>10.0f} /s".format("trie lookups", len(addresses) / lookup))
+    print("{:<24} {:>10.0f} /s".format("linear lookups", len(sample) / scan))
+
+
+def held_memory(function):
+    """Return the bytes allocated by function that its result still holds."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def run_memory(args):
+    """Measure the memory held by records and by dicts on synthetic devices."""
+    print("{:>8} {:>16} {:>16} {:>16}".format(
+        "peers", "records, text", "records, netlink", "baseline dicts"))
+    for count in args.memory:
+        text = synthetic_dump(count)
+        payloads = synthetic_replies(count)
+        sizes = [
+            held_memory(lambda: list(wireguard.parse_dump(text.splitlines(True)))),
+            held_memory(lambda: list(wireguard.device_rows("wg0", payloads))),
+            held_memory(lambda: baseline_dump(text)),
+        ]
+        print("{:>8} {}".format(count, " ".join(
+            "{:>7.1f} MB {:>3} B".format(size / 1e6, size // count) for size in sizes)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the wireguard netlink parser.")
+    parser.add_argument("--dump", type=int, metavar="PEERS",
+                        help="time wireguard_dump() for a device with PEERS peers")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of runs to take the best time of")
+    parser.add_argument("--memory", type=int, nargs="*", metavar="PEERS",
+                        help="measure the memory held for devices with PEERS peers, "
+                             "1000 10000 100000 if none are given")
+    parser.add_argument("--trie", type=int, metavar="PEERS",
+                        help="time AllowedIPsTrie lookups for PEERS peers")
+    args = parser.parse_args()
+
+    if args.dump:
+        run_dump(args)
+        sys.exit(0)
+    if args.trie:
+        run_trie(args)
+        sys.exit(0)
+    if args.memory is not None:
+        args.memory = args.memory or [1000, 10000, 100000]
+        run_memory(args)
+        sys.exit(0)
+
+    problems = check()
+    for problem in problems:
+        print(problem)
+    print("{} problems".format(len(problems)))
+    sys.exit(1 if problems else 0)